@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+# @Function
+# Benchmark of show-busy-java-threads with synthetic inputs: top/ps output of many threads,
+# a fake /proc tree of many JVMs, and giant jstack dumps.
+#
+# @Usage
+#   $ bench/bench_show_busy_java_threads.py
+#   $ bench/bench_show_busy_java_threads.py --quick
+#   $ bench/bench_show_busy_java_threads.py --dump-threads 100,1000,20000 --stack-depth 64
+#
+# Measure the parsing and ranking paths (top output parsing, ps pid/user completion, proc sampler,
+# jstack dump indexing and printing of busy threads, lock graph), report the throughput and the peak memory,
+# so as to catch scaling regressions like the O(threads x ps lines) matching.
+#
+__author__ = 'yunmaoQu'
+import os
+import sys
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import contextlib
+import importlib.util
+
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+TOOL_PATH = os.path.join(BENCH_DIR, '..', 'bin', 'show-busy-java-threads.py')
+
+JVM_USERS = ('app', 'admin', 'tomcat', 'kafka')
+
+
+def load_tool(proc_root):
+    """
+    Load show-busy-java-threads as module. The tool parses its command line when loaded,
+    so load it in socket attach mode (no jstack lookup) with the proc sampler on the fake proc tree.
+    """
+    argv = sys.argv
+    sys.argv = [TOOL_PATH, '--attach-mode', 'socket', '--sampler', 'proc', '--proc-root', proc_root, '-c', '0']
+    try:
+        spec = importlib.util.spec_from_file_location('show_busy_java_threads', TOOL_PATH)
+        tool = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(tool)
+    finally:
+        sys.argv = argv
+    return tool
+
+
+def jvm_threads(jvm_count, thread_count):
+    """Return list of (pid, tid, %CPU, user) of the synthetic JVMs, threads are spread over the JVMs."""
+    rnd = random.Random(42)
+    threads = []
+    threads_per_jvm = max(thread_count // jvm_count, 1)
+    for jvm_idx in range(jvm_count):
+        pid = 10000 + jvm_idx * (threads_per_jvm + 10)
+        user = JVM_USERS[jvm_idx % len(JVM_USERS)]
+        for thread_idx in range(threads_per_jvm):
+            tid = pid + thread_idx
+            pcpu = rnd.choice((0.0, 0.0, 0.0, 0.3, 1.2, 5.5, 42.0, 99.9))
+            threads.append((str(pid), str(tid), f"{pcpu:.1f}", user))
+    return threads
+
+
+def generate_top_output(threads):
+    """Generate the output of `top -H -b -n 2`, 2 snapshots of all threads."""
+    header = ("top - 10:00:00 up 10 days,  1:00,  1 user,  load average: 4.00, 4.00, 4.00\n"
+              f"Threads: {len(threads)} total,   8 running, {len(threads) - 8} sleeping,   0 stopped,   0 zombie\n"
+              "%Cpu(s): 50.0 us,  1.0 sy,  0.0 ni, 49.0 id,  0.0 wa,  0.0 hi,  0.0 si,  0.0 st\n"
+              "MiB Mem :  64000.0 total,  32000.0 free,  30000.0 used,   2000.0 buff/cache\n"
+              "MiB Swap:      0.0 total,      0.0 free,      0.0 used.  33000.0 avail Mem\n"
+              "\n"
+              "    PID USER      PR  NI    VIRT    RES    SHR S  %CPU  %MEM     TIME+ COMMAND\n")
+    lines = [f"{tid:>7} {user:<9} 20   0   10.0g   1.0g  10000 S {pcpu:>5}   1.0   1:00.00 java\n"
+             for _, tid, pcpu, user in threads]
+    snapshot = header + ''.join(lines)
+    return snapshot + "\n" + snapshot
+
+
+def generate_ps_output(threads):
+    """Generate the output of `ps -wwLo 'pid,lwp,user'`."""
+    return ''.join(f"{pid:>7} {tid:>7} {user}\n" for pid, tid, _, user in threads)
+
+
+def generate_proc_tree(proc_root, threads):
+    """Generate a fake /proc tree of the JVMs and their threads."""
+    os.makedirs(proc_root)
+    with open(os.path.join(proc_root, 'uptime'), 'w') as f:
+        f.write("864000.00 6000000.00\n")
+    pids = {}
+    for pid, tid, pcpu, user in threads:
+        if pid not in pids:
+            pids[pid] = user
+            os.makedirs(os.path.join(proc_root, pid, 'task'))
+            with open(os.path.join(proc_root, pid, 'comm'), 'w') as f:
+                f.write("java\n")
+            uid = 1000 + JVM_USERS.index(user)
+            with open(os.path.join(proc_root, pid, 'status'), 'w') as f:
+                f.write(f"Name:\tjava\nUid:\t{uid}\t{uid}\t{uid}\t{uid}\nGid:\t{uid}\t{uid}\t{uid}\t{uid}\nNSpid:\t{pid}\n")
+        task_dir = os.path.join(proc_root, pid, 'task', tid)
+        os.makedirs(task_dir)
+        ticks = int(float(pcpu) * 1000)
+        with open(os.path.join(task_dir, 'stat'), 'w') as f:
+            f.write(f"{tid} (java) S {pid} {pid} {pid} 0 -1 4194368 100 0 0 0 {ticks} {ticks // 10} 0 0 20 0 "
+                    f"{len(threads)} 0 1000 10000000000 100000 18446744073709551615 1 1 0 0 0 0 4 0 16800973 0 0 0 "
+                    f"17 3 0 0 0 0 0\n")
+        with open(os.path.join(task_dir, 'schedstat'), 'w') as f:
+            f.write(f"{ticks * 10000000} {ticks * 100000} {ticks}\n")
+        with open(os.path.join(task_dir, 'status'), 'w') as f:
+            f.write(f"Name:\tjava\nNSpid:\t{tid}\nvoluntary_ctxt_switches:\t{ticks // 7}\n"
+                    f"nonvoluntary_ctxt_switches:\t{ticks // 100}\n")
+
+
+def generate_jstack_dump(jstack_file, pid, thread_count, stack_depth):
+    """Generate a jstack output of the threads, with the stack depth. Return the thread ids."""
+    rnd = random.Random(thread_count)
+    methods = [f"com.example.service{n % 17}.Handler{n % 31}.handle{n % 7}" for n in range(256)]
+    thread_ids = []
+    with open(jstack_file, 'w') as f:
+        f.write("2024-01-02 03:04:05\nFull thread dump OpenJDK 64-Bit Server VM (17.0.9+9 mixed mode, sharing):\n\n")
+        for thread_idx in range(thread_count):
+            tid = int(pid) + thread_idx
+            thread_ids.append(str(tid))
+            f.write(f'"pool-1-thread-{thread_idx}" #{thread_idx + 20} prio=5 os_prio=0 cpu=10.00ms elapsed=100.00s '
+                    f'tid=0x00007f{tid:010x} nid=0x{tid:x} waiting on condition  [0x00007f0000000000]\n')
+            f.write("   java.lang.Thread.State: RUNNABLE\n")
+            for depth in range(stack_depth):
+                method = methods[rnd.randrange(len(methods))]
+                f.write(f"\tat {method}(Handler.java:{depth + 1})\n")
+                # blocking chains of 4 threads: a thread waits for the monitor held by the previous one
+                if depth == 0 and thread_idx % 4:
+                    f.write(f"\t- waiting to lock <0x00000007{tid - 1:08x}> (a java.lang.Object)\n")
+                if depth == 2:
+                    f.write(f"\t- locked <0x00000007{tid:08x}> (a java.lang.Object)\n")
+            f.write("\tat java.lang.Thread.run(Thread.java:833)\n\n   Locked ownable synchronizers:\n\t- None\n\n")
+        f.write('"VM Thread" os_prio=0 cpu=100.00ms elapsed=100.00s tid=0x00007f0000000001 nid=0x1 runnable\n\n')
+        f.write("JNI global refs: 100, weak refs: 0\n\n")
+    return thread_ids
+
+
+def measure(func, repeat):
+    """Run the function repeat times, return (min seconds, peak traced memory bytes of a run)."""
+    best = float('inf')
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    tracemalloc.start()
+    func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return best, peak
+
+
+def report(case, items, unit, seconds, peak):
+    print(f"{case:<48} {items:>9} {unit:<8} {seconds * 1000:>10.2f}ms {items / seconds:>14,.0f} {unit}/s "
+          f"{peak / 1024 / 1024:>9.2f}MiB")
+
+
+def bench_sampling(tool, work_dir, thread_count, jvm_count, repeat):
+    """Benchmark the ranking paths of top/ps output and the proc sampler."""
+    threads = jvm_threads(jvm_count, thread_count)
+    top_out = generate_top_output(threads)
+    ps_out = generate_ps_output(threads)
+
+    seconds, peak = measure(lambda: tool.parse_top_output(top_out), repeat)
+    report(f"parse top output ({jvm_count} JVMs)", len(threads), "threads", seconds, peak)
+
+    top_threads = tool.parse_top_output(top_out)
+    seconds, peak = measure(lambda: tool.complete_pid_user(top_threads, ps_out), repeat)
+    report(f"complete pid/user by ps output ({jvm_count} JVMs)", len(threads), "threads", seconds, peak)
+
+    proc_root = os.path.join(work_dir, f"proc_{thread_count}")
+    generate_proc_tree(proc_root, threads)
+    tool.proc_root = proc_root
+    tool.cpu_sample_interval = 0
+    seconds, peak = measure(lambda: tool.find_busy_java_threads_by_proc(0), repeat)
+    report(f"proc sampler ({jvm_count} JVMs)", len(threads), "threads", seconds, peak)
+
+
+def bench_dump(tool, dump_threads, stack_depth, busy_count, repeat):
+    """Benchmark the indexing of a jstack dump and printing of the stacks of busy threads."""
+    pid = '20000'
+    round_num = 0
+    jstack_file = f"{tool.store_file_prefix}{round_num + 1}_jstack_{pid}"
+    thread_ids = generate_jstack_dump(jstack_file, pid, dump_threads, stack_depth)
+    dump_mb = os.path.getsize(jstack_file) / 1024 / 1024
+
+    def index_dump():
+        tool.JstackDumpIndex(jstack_file).close()
+
+    seconds, peak = measure(index_dump, repeat)
+    report(f"index jstack dump ({dump_mb:.1f}MiB, depth {stack_depth})", dump_threads, "threads", seconds, peak)
+
+    rnd = random.Random(dump_threads)
+    busy_threads = [(pid, tid, '99.9', 'app') for tid in rnd.sample(thread_ids, min(busy_count, len(thread_ids)))]
+
+    def print_stacks():
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            tool.print_stack_of_threads(busy_threads, round_num)
+
+    seconds, peak = measure(print_stacks, repeat)
+    report(f"print {len(busy_threads)} busy stacks of {dump_threads}-thread dump", len(busy_threads), "threads", seconds, peak)
+
+    def group_stacks():
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            tool.print_stack_groups_of_threads(all_threads, round_num)
+
+    all_threads = [(pid, tid, '1.0', 'app') for tid in thread_ids]
+    seconds, peak = measure(group_stacks, repeat)
+    report(f"group stacks of all threads ({dump_threads}-thread dump)", dump_threads, "threads", seconds, peak)
+
+    def lock_graph():
+        jstack_index = tool.JstackDumpIndex(jstack_file, parse_locks=True)
+        tool.LockGraph(jstack_index).blocking_chains()
+        jstack_index.close()
+
+    seconds, peak = measure(lock_graph, repeat)
+    report(f"lock graph of {dump_threads}-thread dump", dump_threads, "threads", seconds, peak)
+    os.remove(jstack_file)
+
+
+def parse_int_list(value):
+    return [int(n) for n in value.split(',')]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark of show-busy-java-threads with synthetic inputs.")
+    parser.add_argument("--threads", type=int, default=10000, help="thread count of top/ps output and proc tree (default: 10000)")
+    parser.add_argument("--jvms", type=int, default=50, help="JVM count of top/ps output and proc tree (default: 50)")
+    parser.add_argument("--dump-threads", type=parse_int_list, default=[100, 1000, 5000, 20000],
+                        help="comma separated thread counts of jstack dumps (default: 100,1000,5000,20000)")
+    parser.add_argument("--stack-depth", type=int, default=32, help="stack depth of threads in jstack dumps (default: 32)")
+    parser.add_argument("--busy", type=int, default=5, help="busy thread count to print stacks (default: 5)")
+    parser.add_argument("--repeat", type=int, default=3, help="repeat times of each case, the best is reported (default: 3)")
+    parser.add_argument("--quick", action="store_true", help="small inputs for a quick check")
+    args = parser.parse_args()
+    if args.quick:
+        args.threads, args.jvms, args.dump_threads, args.repeat = 1000, 10, [100, 1000], 1
+
+    work_dir = tempfile.mkdtemp(prefix="bench_show_busy_java_threads_")
+    try:
+        tool = load_tool(work_dir)
+        tool.count = 0
+        print(f"{'case':<48} {'items':>9} {'':<8} {'best':>12} {'throughput':>23} {'peak mem':>12}")
+        bench_sampling(tool, work_dir, args.threads, args.jvms, args.repeat)
+        for dump_threads in args.dump_threads:
+            bench_dump(tool, dump_threads, args.stack_depth, args.busy, args.repeat)
+        tool.cleanup_when_exit()
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
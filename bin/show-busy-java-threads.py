@@ -37,6 +37,23 @@ from datetime import datetime
 import sys
 import argparse
 import shutil
+import concurrent.futures
+import collections
+import threading
+import pwd
+import re
+import hashlib
+import json
+import contextlib
+import resource
+import mmap
+import struct
+import socket
+import atexit
+import http.server
+import zlib
+import glob
+import fcntl
 
 
 # Global Variables
@@ -51,20 +68,72 @@ UNAME = os.uname().sysname
 NL = '\n'  # New line character
 
 # Utility Functions
+class OutputSink:
+    """
+    Sink of the run output: the console, and the files of -a option and -S option (`<PROG>_log`).
+
+    The files are opened once and kept open for the session, writes are buffered,
+    and flushed at the end of each round and on exit/signals.
+    In jsonl format, the busy thread records go to stdout and the files,
+    while the text messages (headers, errors) go to stderr only, so the record stream keeps parsable.
+    """
+
+    def __init__(self, file_paths=(), jsonl=False):
+        self.jsonl = jsonl
+        self.files = [open(path, 'a', buffering=64 * 1024) for path in file_paths]
+
+    def _console(self):
+        # resolve at call time, stdout may be replaced (e.g. redirect_stdout)
+        return sys.stderr if self.jsonl else sys.stdout
+
+    def write(self, message, color_code=None):
+        """
+        Write a text message. Colored messages are colored on the console if it's a terminal,
+        and logged to the files uncolored, e.g. the headings of the round diff and watch mode.
+        """
+        console = self._console()
+        if color_code is not None and console.isatty():
+            console.write(f"\033[1;{color_code}m{message}\033[0m\n")
+        else:
+            console.write(message + '\n')
+        if not self.jsonl:
+            for f in self.files:
+                f.write(message + '\n')
+
+    def write_record(self, record):
+        """Write a record as a compact json line."""
+        line = json.dumps(record, separators=(',', ':')) + '\n'
+        sys.stdout.write(line)
+        for f in self.files:
+            f.write(line)
+
+    def flush(self):
+        for stream in (sys.stdout, sys.stderr, *self.files):
+            try:
+                stream.flush()
+            except (OSError, ValueError):
+                pass
+
+    def close(self):
+        self.flush()
+        for f in self.files:
+            f.close()
+        self.files = []
+
+# console only until the files of options are checked
+output_sink = OutputSink()
+
 def color_output(color_code, message):
     """
-    Print message with color if stdout is a terminal.
+    Print message with color if the console is a terminal, and append to file if necessary.
     """
-    if sys.stdout.isatty():
-        print(f"\033[1;{color_code}m{message}\033[0m")
-    else:
-        print(message)
+    output_sink.write(message, color_code)
+
 def normal_output(message):
     """
     Print normal output and append to file if necessary.
     """
-    print(message)
-    append_to_file(message, append_file=append_file, store_dir=store_dir)
+    output_sink.write(message)
 
 def red_output(message):
     color_output(31, message)
@@ -78,18 +147,622 @@ def yellow_output(message):
 def blue_output(message):
     color_output(36, message)
 
+class FoldedStackWriter:
+    """
+    Writer of collapsed stacks (`frame;frame;frame count` lines, root frame first) for flame graphs.
+
+    The stacks are weighted by the measured %CPU of the busy thread, in unit of 0.01% CPU.
+    The identical stacks of a round are merged, and written to the file at the end of the round,
+    so the stacks of all rounds are not kept in memory; flame graph tools sum the same stack
+    across rounds.
+    """
+
+    def __init__(self, folded_file):
+        self.file = open(folded_file, 'w')
+        self.round_stacks = collections.Counter()
+
+    def add(self, frames, pcpu):
+        """Add the stack (top frame first) of a busy thread with its %CPU."""
+        if frames:
+            self.round_stacks[';'.join(frame_method(frame) for frame in reversed(frames))] += pcpu * 100
+
+    def flush_round(self):
+        """Write the stacks of the round to the file."""
+        for stack, weight in self.round_stacks.items():
+            weight = round(weight)
+            if weight > 0:
+                self.file.write(f"{stack} {weight}\n")
+        self.round_stacks.clear()
+        self.file.flush()
+
+    def close(self):
+        self.flush_round()
+        self.file.close()
+
+class HistoryStore:
+    """
+    Append-only, memory-mapped time series store of busy thread CPU usage.
 
-def append_to_file(message, append_file=None, store_dir=None):
+    The file is a header (magic, record count) followed by fixed-width records of
+    (timestamp, pid, tid, %CPU, stack hash). The file grows by preallocated chunks, and is
+    rotated to `<file>.1`, `<file>.2`... when it would exceed the max size.
+    The record count in the header is updated after the records are written,
+    so a reader always sees complete records.
     """
-    Append the given message to the specified file or to the store file.
+    MAGIC = b'SBJTHIS1'
+    HEADER = struct.Struct('<8sQ')
+    RECORD = struct.Struct('<dIIfQ')
+    GROW_RECORDS = 4096
+    ROTATE_KEEP = 4
+
+    def __init__(self, history_file, max_bytes):
+        self.history_file = history_file
+        self.max_bytes = max(max_bytes, self.HEADER.size + self.RECORD.size)
+        self.file = None
+        self.mmap = None
+        self.record_count = 0
+        self._open()
+
+    def _open(self):
+        if not os.path.exists(self.history_file):
+            with open(self.history_file, 'wb') as f:
+                f.write(self.HEADER.pack(self.MAGIC, 0))
+        self.file = open(self.history_file, 'r+b')
+        magic, self.record_count = self.HEADER.unpack(self.file.read(self.HEADER.size))
+        if magic != self.MAGIC:
+            raise ValueError(f"{self.history_file} is not a history file of {PROG}")
+        self.mmap = mmap.mmap(self.file.fileno(), 0)
+
+    def _close(self):
+        self.mmap.close()
+        # drop the preallocated but unused tail
+        self.file.truncate(self.HEADER.size + self.record_count * self.RECORD.size)
+        self.file.close()
+
+    def _rotate(self):
+        self._close()
+        for n in range(self.ROTATE_KEEP - 1, 0, -1):
+            if os.path.exists(f"{self.history_file}.{n}"):
+                os.replace(f"{self.history_file}.{n}", f"{self.history_file}.{n + 1}")
+        os.replace(self.history_file, f"{self.history_file}.1")
+        self._open()
+
+    def append(self, records):
+        """Append the records of (timestamp, pid, tid, %CPU, stack hash)."""
+        if not records:
+            return
+        used_size = self.HEADER.size + (self.record_count + len(records)) * self.RECORD.size
+        if used_size > self.max_bytes and self.record_count > 0:
+            self._rotate()
+            used_size = self.HEADER.size + len(records) * self.RECORD.size
+        if used_size > len(self.mmap):
+            grow_size = max(used_size, len(self.mmap) + self.GROW_RECORDS * self.RECORD.size)
+            self.mmap.close()
+            self.file.truncate(min(grow_size, max(self.max_bytes, used_size)))
+            self.mmap = mmap.mmap(self.file.fileno(), 0)
+
+        offset = self.HEADER.size + self.record_count * self.RECORD.size
+        for record in records:
+            self.RECORD.pack_into(self.mmap, offset, *record)
+            offset += self.RECORD.size
+        self.record_count += len(records)
+        self.HEADER.pack_into(self.mmap, 0, self.MAGIC, self.record_count)
+
+    def flush(self):
+        self.mmap.flush()
+
+    def close(self):
+        self._close()
+
+def history_files(history_file):
+    """Return the history file and its rotated files, oldest first."""
+    rotated_files = []
+    n = 1
+    while os.path.exists(f"{history_file}.{n}"):
+        rotated_files.append(f"{history_file}.{n}")
+        n += 1
+    return rotated_files[::-1] + [history_file]
+
+def iter_history_records(history_file):
+    """Iterate the records of the history file and its rotated files, oldest first, by memory-mapping them."""
+    for path in history_files(history_file):
+        with open(path, 'rb') as f:
+            magic, record_count = HistoryStore.HEADER.unpack(f.read(HistoryStore.HEADER.size))
+            if magic != HistoryStore.MAGIC:
+                raise ValueError(f"{path} is not a history file of {PROG}")
+            if record_count == 0:
+                continue
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                # the records are unpacked from a view of the mapping instead of a copy, and up to
+                # the end of the file, which may be truncated (e.g. by a full disk) after the header is updated
+                record_count = min(record_count, (len(mm) - HistoryStore.HEADER.size) // HistoryStore.RECORD.size)
+                end = HistoryStore.HEADER.size + record_count * HistoryStore.RECORD.size
+                # the view is released before the mapping is closed
+                with memoryview(mm)[HistoryStore.HEADER.size:end] as records:
+                    yield from HistoryStore.RECORD.iter_unpack(records)
+
+def parse_query_time(value):
+    """Parse time of query option, epoch seconds or ISO format like `2024-01-02 03:04:05`."""
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return datetime.fromisoformat(value).timestamp()
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"illegal time ({value}), use epoch seconds or format like 2024-01-02 03:04:05")
+
+def format_record_time(timestamp):
+    return datetime.fromtimestamp(timestamp).strftime("%Y-%m-%d %H:%M:%S.%f")
+
+def query_main(argv):
     """
-    if append_file and os.access(append_file, os.W_OK):
-        with open(append_file, 'a') as f:
-            f.write(message + '\n')
-    if store_dir:
-        store_file = os.path.join(store_dir, f"{PROG}_log")
-        with open(store_file, 'a') as f:
-            f.write(message + '\n')
+    The `query` subcommand: query the history file written by option --history-file.
+    """
+    query_parser = argparse.ArgumentParser(prog=f"{PROG} query", description="Query the busy thread CPU history file.")
+    query_parser.add_argument("history_file", help="history file written by option --history-file")
+    query_parser.add_argument("--from", dest="from_time", type=parse_query_time, help="start time, epoch seconds or ISO format")
+    query_parser.add_argument("--to", dest="to_time", type=parse_query_time, help="end time, epoch seconds or ISO format")
+    query_parser.add_argument("-p", "--pid", type=int, help="only the threads of the java process")
+    query_parser.add_argument("-t", "--tid", type=int, help="print the CPU history of the thread, instead of top threads")
+    query_parser.add_argument("-c", "--count", type=int, default=10, help="top threads count to print (default: 10)")
+    query_args = query_parser.parse_args(argv)
+
+    if not os.path.isfile(query_args.history_file):
+        query_parser.error(f"history file {query_args.history_file} is not found!")
+
+    def selected(record):
+        timestamp, pid, tid = record[:3]
+        return ((query_args.from_time is None or timestamp >= query_args.from_time)
+                and (query_args.to_time is None or timestamp <= query_args.to_time)
+                and (query_args.pid is None or pid == query_args.pid)
+                and (query_args.tid is None or tid == query_args.tid))
+
+    records = filter(selected, iter_history_records(query_args.history_file))
+    if query_args.tid is not None:
+        print(f"{'time':<26} {'pid':>8} {'tid':>8} {'%CPU':>6}  stack hash")
+        for timestamp, pid, tid, pcpu, hash_value in records:
+            print(f"{format_record_time(timestamp):<26} {pid:>8} {tid:>8} {pcpu:>6.1f}  {hash_value:016x}")
+        return 0
+
+    # (pid, tid) -> [samples, total %CPU, max %CPU, stack hash of the busiest sample]
+    threads = {}
+    for _, pid, tid, pcpu, hash_value in records:
+        thread = threads.get((pid, tid))
+        if thread is None:
+            thread = threads[(pid, tid)] = [0, 0.0, -1.0, 0]
+        thread[0] += 1
+        thread[1] += pcpu
+        if pcpu > thread[2]:
+            thread[2] = pcpu
+            thread[3] = hash_value
+    top_threads = sorted(threads.items(), key=lambda item: item[1][1], reverse=True)
+    if query_args.count > 0:
+        top_threads = top_threads[:query_args.count]
+
+    print(f"{'pid':>8} {'tid':>8} {'nid':>8} {'samples':>8} {'avg%CPU':>8} {'max%CPU':>8}  stack hash of max")
+    for (pid, tid), (samples, total_pcpu, max_pcpu, hash_value) in top_threads:
+        print(f"{pid:>8} {tid:>8} {tid:>#8x} {samples:>8} {total_pcpu / samples:>8.1f} {max_pcpu:>8.1f}  {hash_value:016x}")
+    return 0
+
+class ArtifactStore:
+    """
+    Store of the artifacts of -S option (jstack dumps, top/ps/proc outputs) in segmented pack files.
+
+    A pack is a zlib stream of records, flushed at the end of each round. The thread blocks of jstack
+    dumps are content-addressed: the body of a thread block (below its header line, which has the
+    changing cpu/elapsed times) is stored once in a pack, and the manifest of each artifact lists
+    the inline text and the block references to reconstruct it. A pack references only its own blocks,
+    so the oldest packs can be removed when the total size of packs exceeds the max bytes.
+    The pack being written is locked exclusively by flock, so that the concurrent runs sharing
+    the store dir remove the finished packs only.
+    """
+    PACK_PREFIX = 'pack_'
+    # record: kind, payload length
+    RECORD_HEADER = struct.Struct('<BI')
+    BLOCK_RECORD = 1
+    MANIFEST_RECORD = 2
+    HASH_SIZE = 16
+    SEGMENT_BYTES_MIN = 1024 * 1024
+    SEGMENT_BYTES_MAX = 64 * 1024 * 1024
+
+    def __init__(self, store_dir, run_id, max_bytes):
+        self.store_dir = store_dir
+        self.run_id = run_id
+        self.max_bytes = max_bytes
+        # a pack is rolled over at 1/16 of the max bytes, so rotation removes a small part of the store
+        self.segment_bytes = self.SEGMENT_BYTES_MAX
+        if max_bytes > 0:
+            self.segment_bytes = min(max(max_bytes // 16, self.SEGMENT_BYTES_MIN), self.SEGMENT_BYTES_MAX)
+        # artifacts are added from the sampler thread (top/ps/proc) and the output thread (jstack)
+        self.lock = threading.Lock()
+        self.segment_num = 0
+        self._open_pack()
+
+    def _open_pack(self):
+        self.segment_num += 1
+        self.pack_path = os.path.join(self.store_dir, f"{self.PACK_PREFIX}{self.run_id}_{self.segment_num:06d}")
+        self.pack = open(self.pack_path, 'wb')
+        # released when the pack is closed, or the run is killed
+        fcntl.flock(self.pack.fileno(), fcntl.LOCK_EX)
+        self.compressor = zlib.compressobj()
+        self.block_hashes = set()
+
+    def _close_pack(self):
+        self.pack.write(self.compressor.flush())
+        self.pack.close()
+
+    def _write_record(self, kind, payload):
+        self.pack.write(self.compressor.compress(self.RECORD_HEADER.pack(kind, len(payload))))
+        self.pack.write(self.compressor.compress(payload))
+
+    def _write_manifest(self, round_num, name, size, parts):
+        manifest = {'run': self.run_id, 'round': round_num + 1, 'name': name, 'size': size, 'parts': parts}
+        self._write_record(self.MANIFEST_RECORD, json.dumps(manifest, separators=(',', ':')).encode())
+
+    def add_text(self, round_num, name, text):
+        """Add a text artifact of the round, e.g. the output of top/ps."""
+        with self.lock:
+            self._write_manifest(round_num, name, len(text.encode()), [['t', text]])
+
+    def add_dump(self, round_num, name, dump_file):
+        """Add a jstack output file of the round, the unchanged thread blocks are stored once in a pack."""
+        parts = []
+
+        def add_text_part(text):
+            parts.append(['t', text.decode(errors='surrogateescape')])
+
+        with self.lock, open(dump_file, 'rb') as f:
+            size = os.fstat(f.fileno()).st_size
+            if size > 0:
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as dump:
+                    # thread blocks are split as JstackDumpIndex does: a block starts with the header line
+                    # of the quoted thread name, and ends before the next line that is not indented
+                    boundaries = [0] + [match.end() for match in JSTACK_BLOCK_BOUNDARY_PATTERN.finditer(dump)]
+                    boundaries.append(size)
+                    text_start = 0
+                    for start, end in zip(boundaries, boundaries[1:]):
+                        if dump[start:start + 1] != b'"':
+                            continue
+                        header_end = dump.find(b'\n', start, end) + 1 or end
+                        header = dump[start:header_end]
+                        if not JSTACK_NID_PATTERN.search(header):
+                            continue
+                        if text_start < start:
+                            add_text_part(dump[text_start:start])
+                        body = dump[header_end:end]
+                        block_hash = hashlib.blake2b(body, digest_size=self.HASH_SIZE).digest()
+                        if block_hash not in self.block_hashes:
+                            self.block_hashes.add(block_hash)
+                            self._write_record(self.BLOCK_RECORD, block_hash + body)
+                        parts.append(['b', header.decode(errors='surrogateescape'), block_hash.hex()])
+                        text_start = end
+                    if text_start < size:
+                        add_text_part(dump[text_start:size])
+            self._write_manifest(round_num, name, size, parts)
+
+    def flush(self):
+        """Flush the pack at the end of a round, roll over to a new pack and rotate when the pack is full."""
+        with self.lock:
+            self.pack.write(self.compressor.flush(zlib.Z_SYNC_FLUSH))
+            self.pack.flush()
+            if self.pack.tell() >= self.segment_bytes:
+                self._close_pack()
+                self._open_pack()
+                self._rotate()
+
+    def _rotate(self):
+        """
+        Remove the oldest finished packs of the store dir (of any run) until the total size is under the max bytes,
+        the packs being written by this run and the concurrent runs are kept.
+        """
+        if self.max_bytes <= 0:
+            return
+        packs = [(pack_path, os.path.getsize(pack_path)) for pack_path in store_packs(self.store_dir)]
+        total_size = sum(pack_size for _, pack_size in packs)
+        for pack_path, pack_size in packs:
+            if total_size <= self.max_bytes:
+                break
+            if pack_path == self.pack_path or is_pack_active(pack_path):
+                continue
+            os.remove(pack_path)
+            total_size -= pack_size
+
+    def close(self):
+        with self.lock:
+            if not self.pack.closed:
+                self._close_pack()
+
+def is_pack_active(pack_path):
+    """Check if the pack is being written by a run, which holds the exclusive flock of it."""
+    try:
+        with open(pack_path, 'rb') as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        return True
+    except OSError:
+        # removed meanwhile
+        return False
+    return False
+
+def store_packs(store_dir):
+    """Return the pack files of the store dir, oldest first (pack names are run timestamp and sequence)."""
+    return sorted(glob.glob(os.path.join(glob.escape(store_dir), f"{ArtifactStore.PACK_PREFIX}*")))
+
+def iter_pack_records(pack_path):
+    """
+    Iterate the (kind, payload) records of a pack file.
+    A pack of a killed run is read up to the last complete record.
+    """
+    header_size = ArtifactStore.RECORD_HEADER.size
+    decompressor = zlib.decompressobj()
+    buffer = b''
+    with open(pack_path, 'rb') as f:
+        while True:
+            chunk = f.read(1024 * 1024)
+            if not chunk:
+                break
+            try:
+                buffer += decompressor.decompress(chunk)
+            except zlib.error:
+                break
+            offset = 0
+            while len(buffer) - offset >= header_size:
+                kind, length = ArtifactStore.RECORD_HEADER.unpack_from(buffer, offset)
+                if len(buffer) - offset - header_size < length:
+                    break
+                yield kind, buffer[offset + header_size:offset + header_size + length]
+                offset += header_size + length
+            buffer = buffer[offset:]
+
+def iter_store_manifests(store_dir):
+    """Iterate the (pack file, manifest) of the artifacts in the store dir."""
+    for pack_path in store_packs(store_dir):
+        for kind, payload in iter_pack_records(pack_path):
+            if kind == ArtifactStore.MANIFEST_RECORD:
+                yield pack_path, json.loads(payload)
+
+def restore_artifacts(pack_path, manifests):
+    """Reconstruct the artifacts of the manifests in the pack, return list of bytes."""
+    block_hashes = {bytes.fromhex(part[2]) for manifest in manifests for part in manifest['parts'] if part[0] == 'b'}
+    blocks = {}
+    if block_hashes:
+        for kind, payload in iter_pack_records(pack_path):
+            if kind == ArtifactStore.BLOCK_RECORD:
+                block_hash = payload[:ArtifactStore.HASH_SIZE]
+                if block_hash in block_hashes:
+                    blocks[block_hash] = payload[ArtifactStore.HASH_SIZE:]
+    artifacts = []
+    for manifest in manifests:
+        chunks = []
+        for part in manifest['parts']:
+            chunks.append(part[1].encode(errors='surrogateescape'))
+            if part[0] == 'b':
+                chunks.append(blocks[bytes.fromhex(part[2])])
+        artifacts.append(b''.join(chunks))
+    return artifacts
+
+def restore_main(argv):
+    """
+    The `restore` subcommand: list the artifacts stored by option -S, or reconstruct the artifacts of a round.
+    """
+    restore_parser = argparse.ArgumentParser(prog=f"{PROG} restore", description="Restore the artifacts stored by option -S.")
+    restore_parser.add_argument("store_dir", help="store directory of option -S")
+    restore_parser.add_argument("--run", help="only the artifacts of the run, by its timestamp (prefix)")
+    restore_parser.add_argument("-r", "--round", type=int, help="reconstruct the artifacts of the round, instead of listing")
+    restore_parser.add_argument("-n", "--name", help="only the artifact of the name, e.g. jstack_42, top, ps, proc")
+    restore_parser.add_argument("-o", "--output-dir", help="write the artifacts to files of the directory, instead of stdout")
+    restore_args = restore_parser.parse_args(argv)
+
+    if not os.path.isdir(restore_args.store_dir):
+        restore_parser.error(f"store directory {restore_args.store_dir} is not found!")
+
+    def selected(manifest):
+        return ((restore_args.run is None or manifest['run'].startswith(restore_args.run))
+                and (restore_args.round is None or manifest['round'] == restore_args.round)
+                and (restore_args.name is None or manifest['name'] == restore_args.name))
+
+    matches = [(pack_path, manifest) for pack_path, manifest in iter_store_manifests(restore_args.store_dir)
+               if selected(manifest)]
+    if restore_args.round is None:
+        print(f"{'run':<28} {'round':>6} {'size':>10}  name")
+        for _, manifest in matches:
+            print(f"{manifest['run']:<28} {manifest['round']:>6} {manifest['size']:>10}  {manifest['name']}")
+        return 0
+
+    if not matches:
+        restore_parser.error("no artifact is found!")
+    if restore_args.output_dir is None and len(matches) > 1:
+        restore_parser.error(f"{len(matches)} artifacts are found, select one by --run/--name, or use --output-dir")
+    if restore_args.output_dir:
+        os.makedirs(restore_args.output_dir, exist_ok=True)
+    # the artifacts of a pack are reconstructed by one more pass of the pack
+    pack_manifests = {}
+    for pack_path, manifest in matches:
+        pack_manifests.setdefault(pack_path, []).append(manifest)
+    for pack_path, manifests in pack_manifests.items():
+        for manifest, artifact in zip(manifests, restore_artifacts(pack_path, manifests)):
+            if restore_args.output_dir is None:
+                sys.stdout.buffer.write(artifact)
+                continue
+            # the file name of the artifact when it is stored uncompressed
+            artifact_file = os.path.join(restore_args.output_dir, f"{manifest['run']}_{manifest['round']}_{manifest['name']}")
+            with open(artifact_file, 'wb') as f:
+                f.write(artifact)
+            print(artifact_file)
+    return 0
+
+class SelfProfile:
+    """
+    Self-overhead instrumentation of the tool: wall time of each phase of every round,
+    CPU/RSS usage of the tool itself and its child processes, and the count of forked processes.
+    Phases of a round may run in different threads (sampler thread and jstack workers).
+    """
+    PHASES = ('discovery', 'cpu_sampling', 'ps_completion', 'jstack', 'parsing', 'output')
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.monotonic()
+        self.fork_count = 0
+        # round num -> {'phases': {phase: seconds}, 'jstack_pids': {pid: seconds}, 'forks': num, 'rss_kb': num}
+        self.rounds = {}
+
+    def _round(self, round_num):
+        round_profile = self.rounds.get(round_num)
+        if round_profile is None:
+            round_profile = self.rounds[round_num] = {'phases': dict.fromkeys(self.PHASES, 0.0), 'jstack_pids': {}, 'forks': 0}
+        return round_profile
+
+    @contextlib.contextmanager
+    def phase(self, round_num, phase):
+        """Measure the wall time of the phase of the round."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(round_num, phase, time.perf_counter() - start)
+
+    def add(self, round_num, phase, seconds):
+        with self.lock:
+            self._round(round_num)['phases'][phase] += seconds
+
+    def add_jstack_pid(self, round_num, pid, seconds):
+        with self.lock:
+            jstack_pids = self._round(round_num)['jstack_pids']
+            jstack_pids[pid] = jstack_pids.get(pid, 0.0) + seconds
+
+    def forget_round(self, round_num):
+        """Forget the profile of the round, so that a long-running serve mode does not keep all rounds."""
+        with self.lock:
+            self.rounds.pop(round_num, None)
+
+    def phase_seconds(self, round_num, phase):
+        with self.lock:
+            return self._round(round_num)['phases'][phase]
+
+    def jstack_pids_seconds(self, round_num):
+        with self.lock:
+            return dict(self._round(round_num)['jstack_pids'])
+
+    def count_fork(self, round_num=None):
+        """Count a forked child process, e.g. ps/top/jstack."""
+        with self.lock:
+            self.fork_count += 1
+            if round_num is not None:
+                self._round(round_num)['forks'] += 1
+
+    def end_round(self, round_num):
+        """Record the RSS of the tool at the end of the round."""
+        rss_kb = read_self_rss_kb()
+        with self.lock:
+            self._round(round_num)['rss_kb'] = rss_kb
+
+    def summary(self, with_rounds):
+        """Return the summary as a dict for JSON output."""
+        usage_self = resource.getrusage(resource.RUSAGE_SELF)
+        usage_children = resource.getrusage(resource.RUSAGE_CHILDREN)
+        with self.lock:
+            phases_total = dict.fromkeys(self.PHASES, 0.0)
+            for round_profile in self.rounds.values():
+                for phase, seconds in round_profile['phases'].items():
+                    phases_total[phase] += seconds
+            summary = {
+                'command_line': COMMAND_LINE,
+                'wall_seconds': round(time.monotonic() - self.start_time, 6),
+                'cpu_user_seconds': usage_self.ru_utime,
+                'cpu_system_seconds': usage_self.ru_stime,
+                'max_rss_kb': usage_self.ru_maxrss,
+                'rss_kb': read_self_rss_kb(),
+                'children_cpu_user_seconds': usage_children.ru_utime,
+                'children_cpu_system_seconds': usage_children.ru_stime,
+                'children_max_rss_kb': usage_children.ru_maxrss,
+                'forked_processes': self.fork_count,
+                'rounds_count': len(self.rounds),
+                'phases_seconds': {phase: round(seconds, 6) for phase, seconds in phases_total.items()},
+            }
+            if with_rounds:
+                summary['rounds'] = [
+                    {'round': round_num + 1,
+                     'phases_seconds': {phase: round(seconds, 6) for phase, seconds in round_profile['phases'].items()},
+                     'jstack_pids_seconds': {pid: round(seconds, 6) for pid, seconds in round_profile['jstack_pids'].items()},
+                     'forked_processes': round_profile['forks'],
+                     'rss_kb': round_profile.get('rss_kb')}
+                    for round_num, round_profile in sorted(self.rounds.items())]
+        return summary
+
+def read_self_rss_kb():
+    """Read the current RSS of the tool itself, from the real /proc (not the sampled proc root)."""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE') // 1024
+    except OSError:
+        return None
+
+class DumpTrigger:
+    """
+    Trigger of watch mode: decide in which rounds to jstack, from the cheap CPU samples of every round.
+
+    Every jstack stops the target JVM at a safepoint, so a java process is dumped only when
+    a busy thread of it stays hot for `trigger_samples` consecutive rounds, with hysteresis:
+    the streak of a thread starts at %CPU >= `trigger_cpu`, continues while %CPU >= `release_cpu`,
+    and a thread that has triggered a dump does not trigger again until its streak is broken.
+    A java process is dumped at most once every `min_dump_interval` seconds, a thread that
+    triggers within the interval keeps pending, and triggers when the interval has passed.
+    """
+
+    def __init__(self, trigger_cpu, release_cpu, trigger_samples, min_dump_interval):
+        self.trigger_cpu = trigger_cpu
+        self.release_cpu = release_cpu
+        self.trigger_samples = trigger_samples
+        self.min_dump_interval = min_dump_interval
+        # (pid, thread id) -> [streak of consecutive hot samples, triggered]
+        self.thread_states = {}
+        # pid -> monotonic time of last dump
+        self.last_dump_times = {}
+        # statistics of the whole run
+        self.sampled_only_rounds = []
+        self.dump_rounds = []
+        self.rate_limited_count = 0
+        self.safepoint_count = 0
+        self.safepoint_seconds = 0.0
+
+    def update(self, round_num, busy_threads, now):
+        """
+        Update the thread states by the busy threads of the round,
+        return (busy threads to dump, busy threads rate limited by min dump interval).
+        """
+        thread_states = {}
+        hot_threads = []
+        for pid, thread_id, pcpu, user in busy_threads:
+            state = self.thread_states.get((pid, thread_id), [0, False])
+            pcpu_value = float(pcpu)
+            if pcpu_value >= self.trigger_cpu or (state[0] > 0 and pcpu_value >= self.release_cpu):
+                state[0] += 1
+                thread_states[(pid, thread_id)] = state
+                if state[0] >= self.trigger_samples and not state[1]:
+                    hot_threads.append((pid, thread_id, pcpu, user))
+            # the threads not hot, or not busy any more, are released
+        self.thread_states = thread_states
+
+        dump_threads = []
+        rate_limited_threads = []
+        for thread in hot_threads:
+            last_dump_time = self.last_dump_times.get(thread[0])
+            if last_dump_time is not None and now - last_dump_time < self.min_dump_interval:
+                rate_limited_threads.append(thread)
+            else:
+                dump_threads.append(thread)
+        for pid, thread_id, _, _ in dump_threads:
+            self.thread_states[(pid, thread_id)][1] = True
+            self.last_dump_times[pid] = now
+        self.rate_limited_count += len(rate_limited_threads)
+        (self.dump_rounds if dump_threads else self.sampled_only_rounds).append(round_num)
+        return dump_threads, rate_limited_threads
+
+    def add_safepoints(self, count, seconds):
+        """Account the dumps of a round; jstack wall time is the upper bound of the safepoint time."""
+        self.safepoint_count += count
+        self.safepoint_seconds += seconds
 
 def log_and_run(command):
     """
@@ -121,23 +794,243 @@ def is_natural_number(value):
 def is_natural_number_list(value_list):
     return all(is_natural_number(value) for value in value_list.split(','))
 
+# /proc reading functions of the native sampler, the proc root is configurable
+# (option --proc-root) so that a synthetic proc tree can be sampled.
+CLK_TCK = os.sysconf('SC_CLK_TCK')
+JAVA_PROCESS_NAMES = ('java', 'jsvc')
+
+_uid_user_cache = {}
+
+def is_proc_sampler_available():
+    """
+    Check if the proc filesystem can be read for sampling thread CPU.
+    """
+    return os.path.isdir(proc_root) and os.access(proc_root, os.R_OK | os.X_OK)
+
+def read_proc_file(*path_parts):
+    """
+    Read a file under the proc root, return None if it does not exist (e.g. the process/thread exited).
+    """
+    try:
+        with open(os.path.join(proc_root, *path_parts)) as f:
+            return f.read()
+    except OSError:
+        return None
+
+def parse_proc_stat(stat):
+    """
+    Parse the content of a /proc/<pid>/task/<tid>/stat file.
+    Return the fields after the `comm` field, the first one is `state` (field 3 of proc(5)).
+    """
+    # comm may contain spaces and parentheses, so split after the last ')'
+    return stat[stat.rindex(')') + 2:].split()
+
+def discover_java_pids_by_proc():
+    """
+    Find the Java process ids by scanning the proc root, like `ps -C java -C jsvc` does.
+    """
+    if pid_list:
+        return [pid for pid in pid_list.split(',') if os.path.isdir(os.path.join(proc_root, pid))]
+
+    java_pids = []
+    for entry in os.listdir(proc_root):
+        if not entry.isdigit():
+            continue
+        comm = read_proc_file(entry, 'comm')
+        if comm is not None and comm.strip() in JAVA_PROCESS_NAMES:
+            java_pids.append(entry)
+    return java_pids
+
+def read_process_user(pid):
+    """
+    Read the effective user name of the process from /proc/<pid>/status.
+    """
+    status = read_proc_file(pid, 'status')
+    if status is None:
+        return None
+    for line in status.splitlines():
+        if line.startswith('Uid:'):
+            uid = int(line.split()[2])
+            if uid not in _uid_user_cache:
+                try:
+                    _uid_user_cache[uid] = pwd.getpwuid(uid).pw_name
+                except KeyError:
+                    _uid_user_cache[uid] = str(uid)
+            return _uid_user_cache[uid]
+    return None
+
+def read_process_ids(pid):
+    """
+    Read the effective (uid, gid) of the process from /proc/<pid>/status, None if not readable.
+    """
+    status = read_proc_file(pid, 'status')
+    if status is None:
+        return None
+    ids = {}
+    for line in status.splitlines():
+        if line.startswith(('Uid:', 'Gid:')):
+            ids[line[:3]] = int(line.split()[2])
+    if len(ids) != 2:
+        return None
+    return ids['Uid'], ids['Gid']
+
+def read_thread_cpu_ticks(pid):
+    """
+    Read the CPU time of all threads of the process from /proc/<pid>/task/<tid>/stat.
+    Return dict of tid -> (utime + stime, starttime), both in clock ticks.
+    """
+    task_dir = os.path.join(pid, 'task')
+    try:
+        tids = os.listdir(os.path.join(proc_root, task_dir))
+    except OSError:
+        return {}
+
+    thread_ticks = {}
+    for tid in tids:
+        stat = read_proc_file(task_dir, tid, 'stat')
+        if stat is None:
+            continue
+        fields = parse_proc_stat(stat)
+        # utime/stime/starttime are field 14/15/22 of proc(5)
+        thread_ticks[tid] = (int(fields[11]) + int(fields[12]), int(fields[19]))
+    return thread_ticks
+
+# scheduler stats of a thread: run queue wait time (milliseconds), nonvoluntary/voluntary context switches
+ThreadSchedStats = collections.namedtuple('ThreadSchedStats', 'runq_wait_ms nvcsw vcsw')
+NO_SCHED_STATS = ThreadSchedStats(0.0, 0, 0)
+CTXT_SWITCHES_PATTERN = re.compile(r'^(non)?voluntary_ctxt_switches:\s*(\d+)', re.MULTILINE)
+
+def read_thread_sched_stats(pid, tids):
+    """
+    Read the scheduler stats of the threads of the process: the run queue wait time from
+    /proc/<pid>/task/<tid>/schedstat, and the context switches from /proc/<pid>/task/<tid>/status.
+    Return dict of tid -> ThreadSchedStats, counted since the thread started.
+    """
+    task_dir = os.path.join(pid, 'task')
+    sched_stats = {}
+    for tid in tids:
+        status = read_proc_file(task_dir, tid, 'status')
+        if status is None:
+            continue
+        ctxt_switches = {prefix: int(value) for prefix, value in CTXT_SWITCHES_PATTERN.findall(status)}
+        # schedstat: time on cpu, time waiting on a run queue (both in nanoseconds), timeslices;
+        # absent without CONFIG_SCHED_INFO
+        schedstat = read_proc_file(task_dir, tid, 'schedstat')
+        runq_wait_ns = int(schedstat.split()[1]) if schedstat else 0
+        sched_stats[tid] = ThreadSchedStats(runq_wait_ns / 1e6, ctxt_switches.get('non', 0), ctxt_switches.get('', 0))
+    return sched_stats
+
+def read_thread_name(pid, tid):
+    """
+    Read the thread name from /proc/<pid>/task/<tid>/comm, the JVM sets it to
+    the java thread name, truncated to 15 bytes by the kernel.
+    """
+    comm = read_proc_file(pid, 'task', tid, 'comm')
+    return comm.rstrip('\n') if comm is not None else ""
+
+def read_thread_nstid(pid, tid):
+    """
+    Read the id of the thread in the pid namespace of its process (the last one of NSpid),
+    the nid of a thread in the jstack output of a containerized JVM is this id.
+    """
+    status = read_proc_file(pid, 'task', tid, 'status')
+    if status is not None:
+        for line in status.splitlines():
+            if line.startswith('NSpid:'):
+                return line.split()[-1]
+    return tid
+
+# fleet mode: identity of a JVM, discovered once and cached by (pid, starttime) across rounds,
+# since pid may be reused by another process after the JVM exited
+JvmInfo = collections.namedtuple('JvmInfo', 'pid start_ticks user nspid cgroup container_id')
+# container id of docker/containerd/cri-o in cgroup path, e.g. `.../cri-containerd-<64 hex>.scope`
+CONTAINER_ID_PATTERN = re.compile(r'[0-9a-f]{64}')
+
+_jvm_info_cache = {}
+
+def read_process_cgroup(pid):
+    """
+    Read the cgroup path of the process from /proc/<pid>/cgroup: the path of the unified
+    hierarchy (cgroup v2), or of the first v1 hierarchy which is not the root cgroup.
+    """
+    cgroup = read_proc_file(pid, 'cgroup')
+    if cgroup is None:
+        return ""
+    paths = []
+    for line in cgroup.splitlines():
+        # hierarchy-ID:controller-list:cgroup-path, hierarchy 0 is the unified one
+        hierarchy_id, _, path = line.split(':', 2)
+        if path == '/':
+            continue
+        if hierarchy_id == '0':
+            paths.insert(0, path)
+        else:
+            paths.append(path)
+    return paths[0] if paths else "/"
+
+def parse_container_id(cgroup):
+    """Parse the container id from the cgroup path, empty if the process is not in a container."""
+    container_ids = CONTAINER_ID_PATTERN.findall(cgroup)
+    return container_ids[-1] if container_ids else ""
+
+def discover_jvms_by_proc():
+    """
+    Find the JVMs of the host by scanning the proc root, return list of JvmInfo.
+    Only one stat file is read for a known process, its user/cgroup/namespace pid are cached.
+    """
+    entries = pid_list.split(',') if pid_list else os.listdir(proc_root)
+    jvms = []
+    live_keys = set()
+    for entry in entries:
+        if not entry.isdigit():
+            continue
+        stat = read_proc_file(entry, 'stat')
+        if stat is None:
+            continue
+        # starttime is field 22 of proc(5)
+        key = (entry, parse_proc_stat(stat)[19])
+        live_keys.add(key)
+        if key in _jvm_info_cache:
+            jvm = _jvm_info_cache[key]
+        else:
+            jvm = None
+            comm = stat[stat.index('(') + 1:stat.rindex(')')]
+            if pid_list or comm in JAVA_PROCESS_NAMES:
+                user = read_process_user(entry)
+                if user:
+                    cgroup = read_process_cgroup(entry)
+                    jvm = JvmInfo(entry, key[1], user, read_process_nspid(entry), cgroup, parse_container_id(cgroup))
+            # non-java processes are cached too, so that they are skipped cheaply by next scans
+            _jvm_info_cache[key] = jvm
+        if jvm is not None:
+            jvms.append(jvm)
+    # forget the exited processes
+    for key in _jvm_info_cache.keys() - live_keys:
+        del _jvm_info_cache[key]
+    return jvms
+
+def read_uptime_ticks():
+    """
+    Read the system uptime from /proc/uptime, in clock ticks.
+    """
+    return float(read_proc_file('uptime').split()[0]) * CLK_TCK
+
 def print_calling_command_line(args):
     """
     Print the full calling command with the arguments.
     """
     return ' '.join(map(str, args))
 
-def die(prompt_help=False, exit_status=2, *args):
-    # Print the error message if any arguments are provided
-    if args:
-        colorPrint("1;31", f"{PROG}: {' '.join(args)}")
-    
-    # If prompt_help is True, print the help message line
-    if prompt_help:
-        print(f"Try '{PROG} --help' for more information.")
-    
-    # Exit with the specified exit status
-    sys.exit(exit_status)
+def die(message, hint=False):
+    """
+    Exit the program with an error message, used by the option checks and at runtime.
+    With hint, also print how to get the help of options.
+    """
+    red_output(f"Error: {message}")
+    if hint:
+        normal_output(f"Try '{PROG} --help' for more information.")
+    output_sink.flush()
+    sys.exit(1)
 def usage():
     usage_text = f"""\
 Usage: {PROG} [OPTION]... [delay [count]]
@@ -157,12 +1050,66 @@ Output control:
   -c, --count <num>         Set the thread count to show, default is 5.
                             Set count 0 to show all threads.
   -a, --append-file <file>  Specifies the file to append output as log.
+  --format <format>         Specifies the output format:
+                            text:  the stack of each busy thread
+                            jsonl: a json record per line of each busy thread,
+                                   with round, timestamp, pid, tid, nid,
+                                   pcpu, user, thread_name and frames;
+                                   other messages go to stderr.
+                            Default is text. jsonl can not be used
+                            with -g or --samples.
   -S, --store-dir <dir>     Specifies the directory for storing
                             the intermediate files, and keep files.
                             Default store intermediate files at tmp dir,
                             and auto remove after run. Use this option to keep
                             files so as to review jstack/top/ps output later.
+                            The jstack/top/ps/proc outputs are kept in
+                            compressed pack files, the thread blocks unchanged
+                            across rounds are stored once. Restore them by
+                            `{PROG} restore <dir>`.
+  --store-max-bytes <num>   Specifies the max size of the pack files of
+                            store directory, remove the oldest pack files
+                            when exceeded, default is 1073741824 (1GiB).
+                            Set 0 for no limit.
+  --history-file <file>     Specifies the file to append the CPU usage and
+                            stack hash of busy threads of every round, as
+                            fixed-width records. Query it later by
+                            `{PROG} query <file>`.
+  --history-max-bytes <num> Specifies the max size of history file, rotate
+                            it to <file>.1, <file>.2... when exceeded,
+                            default is 67108864 (64MiB).
+  --fleet                   Fleet mode, for hosts running many containerized
+                            JVMs: find the busy threads of all JVMs of the
+                            host (in any pid namespace) by the proc sampler,
+                            ranked host-wide, and show the container id
+                            (or cgroup) and the pid in container of each
+                            JVM. The JVMs found are cached between rounds.
+                            Use --jstack-workers to bound the concurrent
+                            jstack runs, --attach-mode socket to dump the
+                            JVMs of containers without jstack of the
+                            same java version.
+  -g, --group-stacks        Group the busy threads with the same stack
+                            (e.g. threads of a pool), print each group once
+                            with its threads, ranked by the total CPU usage
+                            of the group. Useful with -c 0.
+  --diff                    Print the diff of each round against the previous
+                            round after its output: the threads which become
+                            or stop being busy, the CPU delta of the threads
+                            busy in both rounds, and whether their stacks
+                            changed (with the top frames before and after)
+                            or stay the same, compared by stack hash.
+                            Diff two rounds stored by -S offline by
+                            `{PROG} diff <old dir> <new dir>`.
+  --folded-file <file>      Specifies the file to write the stacks of busy
+                            threads of all rounds in collapsed format
+                            (`frame;frame;frame weight` lines) for flame graph
+                            tools. A stack is weighted by the %CPU of its
+                            thread, in unit of 0.01% CPU.
   delay                     The delay between updates in seconds.
+                            Rounds are sampled on a fixed cadence of delay,
+                            while jstack and output of previous round run;
+                            a round is dropped and reported when they
+                            do not keep up with the delay.
   count                     The number of updates.
                             delay/count arguments imitate the style of
                             the vmstat command.
@@ -174,7 +1121,64 @@ jstack control:
   -m, --mix-native-frames   Set jstack to print both Java and
                             native frames (mixed mode).
   -l, --lock-info           Set jstack with long listing.
-                            Prints additional information about locks.
+                            Prints additional information about locks,
+                            and the lock contention of each java process
+                            found from it: deadlocks, and the longest
+                            chains of threads blocked on monitors or
+                            j.u.c. locks, with the holder threads.
+  --no-dump                 Print the busy threads with thread name, %CPU
+                            and hex nid only, without jstack: the thread
+                            names are read from /proc/<pid>/task/<tid>/comm,
+                            the native thread name set by the JVM (JDK 9+,
+                            truncated to 15 characters). No safepoint and no
+                            jstack JVM startup, so it is light enough to
+                            update every round with sub-second delay, e.g.
+                            `{PROG} --no-dump 0.5`.
+  --dump-tid <tid(s)>       Dump the stack of the specified threads only,
+                            instead of the busy threads, e.g. a thread found
+                            by --no-dump. Support thread id list (e.g. 42,47).
+  --attach-mode <mode>      Specifies how to dump threads of java process:
+                            jstack: run jstack command
+                            socket: request the thread dump through the
+                                    HotSpot dynamic attach socket directly,
+                                    without starting a jstack JVM
+                            Default is jstack.
+  --jstack-workers <num>    Specifies the max number of java processes
+                            to jstack concurrently, default is 4.
+  --jstack-timeout <secs>   Specifies the timeout of jstack for each
+                            java process, default is 60 (seconds).
+                            Set timeout 0 to wait jstack without limit.
+  --round-deadline <secs>   Specifies the deadline of all jstack runs
+                            in an update round, default is 0 (no deadline).
+
+Poor-man's profiler control:
+  --samples <num>           Specifies the number of jstack samples taken of
+                            busy java processes in each update round,
+                            default is 1. With more than 1 sample, print the
+                            frames and methods of each busy thread ranked by
+                            the fraction of samples they appear in,
+                            instead of the stack.
+  --sample-gap <millis>     Specifies the gap between jstack samples,
+                            default is 100 (milliseconds).
+
+Watch mode control:
+  --trigger-cpu <pct>       Enable watch mode: sample thread CPU usage every
+                            round, and jstack a java process only when its
+                            thread stays at or above the %CPU for
+                            consecutive samples. Each jstack stops the java
+                            process at a safepoint, so watch mode keeps the
+                            overhead on the diagnosed service low.
+                            The rounds without jstack are printed in one line.
+  --release-cpu <pct>       Specifies the %CPU below which a hot thread is
+                            released (hysteresis), default is 80% of
+                            trigger CPU. A thread triggers jstack again
+                            only after released.
+  --trigger-samples <num>   Specifies the consecutive samples of a thread
+                            at or above trigger CPU to trigger jstack,
+                            default is 3.
+  --min-dump-interval <secs>
+                            Specifies the min interval between jstack of
+                            a java process, default is 60 (seconds).
 
 CPU usage calculation control:
   -i, --cpu-sample-interval Specifies the delay between CPU samples to get
@@ -182,10 +1186,90 @@ CPU usage calculation control:
                             Default is 0.5 (second).
                             Set interval 0 to get the percentage of time spent
                             running during the *entire lifetime* of a process.
+  -P, --use-ps              Use ps to get thread CPU usage percentage,
+                            same as set CPU sample interval 0.
+  --sampler <sampler>       Specifies how to sample thread CPU usage:
+                            auto: proc if proc filesystem is readable, else ps
+                            proc: read /proc/<pid>/task/<tid>/stat directly,
+                                  no ps/top process is forked
+                            ps:   use ps and top commands
+                            Default is auto.
+  --sort-by <metric>        Specifies the metric to choose the top threads,
+                            by the proc sampler:
+                            cpu:       CPU usage percentage
+                            runq-wait: time waiting on a run queue, i.e.
+                                       runnable but starved threads
+                            nvcsw:     nonvoluntary context switches,
+                                       i.e. preempted threads
+                            Default is cpu. The run queue wait and context
+                            switches during the CPU sample interval
+                            (since the thread started if interval is 0)
+                            are shown next to each stack.
+  --proc-root <dir>         Specifies the root of proc filesystem
+                            used by the proc sampler, default is /proc.
 
 Miscellaneous:
+  --self-profile [<file>]   Record the overhead of the tool itself: wall time of
+                            each phase (discovery, cpu_sampling, ps_completion,
+                            jstack and per pid, parsing, output), CPU and RSS
+                            of the tool and its child processes, and the count
+                            of forked processes. Output as JSON at exit to the
+                            file, or stderr if no file; with a per-round
+                            breakdown when delay/count is used.
   -h, --help                Display this help and exit.
   -V, --version             Display version information and exit.
+
+Usage: {PROG} query [OPTION]... <history file>
+Query the history file written by option --history-file.
+
+  --from <time>             Only records since the time, epoch seconds or
+                            ISO format like 2024-01-02 03:04:05.
+  --to <time>               Only records until the time.
+  -p, --pid <pid>           Only the threads of the java process.
+  -t, --tid <tid>           Print the CPU history of the thread.
+                            Default print the top threads by total CPU usage.
+  -c, --count <num>         The top threads count to print, default is 10.
+                            Set count 0 to print all threads.
+
+Usage: {PROG} restore [OPTION]... <store dir>
+List the artifacts (jstack/top/ps/proc outputs) stored by option -S,
+or restore the artifacts of a round.
+
+  --run <timestamp>         Only the artifacts of the run, by its timestamp
+                            (or prefix), e.g. 2024-01-02_03:04.
+  -r, --round <num>         Restore the artifacts of the round, to stdout.
+                            Default list the artifacts.
+  -n, --name <name>         Only the artifact of the name, e.g. jstack_42.
+  -o, --output-dir <dir>    Restore the artifacts to files of the directory,
+                            named <run>_<round>_<name>.
+
+Usage: {PROG} diff [OPTION]... <old store dir> <new store dir>
+Diff the busy threads and their stacks of two rounds stored by -S, as --diff.
+The latest round of the store directory is diffed by default, select the
+rounds by --old-run/--old-round and --new-run/--new-round, e.g. two rounds
+of the same store directory.
+
+  --old-run <timestamp>     The run of the old round, by its timestamp
+                            (or prefix). Default is the latest run.
+  --old-round <num>         The old round. Default is the latest round.
+  --new-run <timestamp>     The run of the new round, as --old-run.
+  --new-round <num>         The new round, as --old-round.
+  -c, --count <num>         The top threads count of each round to diff,
+                            default is 5. Set count 0 to diff all threads.
+
+Usage: {PROG} serve [OPTION]... [delay]
+Sample the CPU usage of java threads in background every delay seconds
+(default is 15), and serve the latest sample as OpenMetrics at /metrics:
+CPU usage and thread count of each java process, and CPU usage of the top
+threads labelled with pid, tid and thread name. Scrapes are served from
+the cached sample, and fork no ps/top/jstack process.
+
+  --listen <host:port>      Specifies the address to listen,
+                            default is 127.0.0.1:9838.
+  -c, --count <num>         The top threads count to export, default is 5.
+                            Set count 0 to export all threads.
+  Options -p, -i, -P, --sampler, --sort-by, --proc-root and --fleet are
+  also supported.
 """
     print(usage_text)
     sys.exit()
@@ -211,6 +1295,16 @@ lock_info = None
 pid_list = None
 append_file = None
 store_dir = None
+# Subcommands
+if len(sys.argv) > 1 and sys.argv[1] == "query":
+    sys.exit(query_main(sys.argv[2:]))
+if len(sys.argv) > 1 and sys.argv[1] == "restore":
+    sys.exit(restore_main(sys.argv[2:]))
+# the `serve` subcommand shares the sampling options, it is run by serve_main after the options are checked
+serve_mode = len(sys.argv) > 1 and sys.argv[1] == "serve"
+# the `diff` subcommand parses the jstack outputs of the store, it is run by diff_main after the module is loaded
+diff_mode = len(sys.argv) > 1 and sys.argv[1] == "diff"
+
 # Argument parsing using argparse
 parser = argparse.ArgumentParser(description="Script to demonstrate argument parsing and validation.",add_help=False)
 parser.add_argument("-c", "--count", type=int, default=5, help="Set count value (default: 5)")
@@ -218,16 +1312,50 @@ parser.add_argument("-p", "--pid", type=str, help="Set pid list")
 parser.add_argument("-a", "--append-file", type=str, help="Set append file")
 parser.add_argument("-s", "--jstack-path", type=str, help="Set jstack path")
 parser.add_argument("-S", "--store-dir", type=str, help="Set store directory")
+parser.add_argument("--format", choices=["text", "jsonl"], default="text", help="Set output format (default: text)")
+parser.add_argument("--store-max-bytes", type=int, default=1024 * 1024 * 1024, help="Set max size of stored artifacts (default: 1GiB)")
+parser.add_argument("--history-file", type=str, help="Set busy thread CPU history file")
+parser.add_argument("--history-max-bytes", type=int, default=64 * 1024 * 1024, help="Set max size of history file before rotation")
+parser.add_argument("-g", "--group-stacks", action="store_true", help="Group threads with the same stack")
+parser.add_argument("--diff", action="store_true", help="Print diff of busy threads and stacks against previous round")
+parser.add_argument("--folded-file", type=str, help="Set collapsed stacks output file")
 parser.add_argument("-i", "--cpu-sample-interval", type=float, default=0.5, help="Set CPU sample interval (default: 0.5)")
 parser.add_argument("-P", "--use-ps", action="store_true", help="Use PS (sets CPU sample interval to 0)")
 parser.add_argument("-d", "--top-delay", type=float, help="Set top delay")
 parser.add_argument("-F", "--force", action="store_true", help="Use force")
 parser.add_argument("-m", "--mix-native-frames", action="store_true", help="Use mix native frames")
 parser.add_argument("-l", "--lock-info", action="store_true", help="Use lock info")
+parser.add_argument("--no-dump", action="store_true", help="Print busy threads with names from proc, without jstack")
+parser.add_argument("--dump-tid", type=str, help="Set thread id list to dump, instead of the busy threads")
+parser.add_argument("--attach-mode", choices=["jstack", "socket"], default="jstack", help="Set how to dump threads (default: jstack)")
+parser.add_argument("--jstack-workers", type=int, default=4, help="Set max concurrent jstack runs (default: 4)")
+parser.add_argument("--jstack-timeout", type=float, default=60, help="Set jstack timeout of each java process (default: 60)")
+parser.add_argument("--round-deadline", type=float, default=0, help="Set deadline of all jstack runs in a round (default: 0, no deadline)")
+parser.add_argument("--samples", type=int, default=1, help="Set jstack samples of each round (default: 1)")
+parser.add_argument("--sample-gap", type=float, default=100, help="Set gap between jstack samples in milliseconds (default: 100)")
+parser.add_argument("--fleet", action="store_true", help="Find busy threads of all JVMs of the host with container identity")
+parser.add_argument("--trigger-cpu", type=float, help="Set %%CPU of a thread to trigger jstack (watch mode)")
+parser.add_argument("--release-cpu", type=float, help="Set %%CPU of a thread to release the trigger (default: 80%% of trigger CPU)")
+parser.add_argument("--trigger-samples", type=int, default=3, help="Set consecutive hot samples to trigger jstack (default: 3)")
+parser.add_argument("--min-dump-interval", type=float, default=60, help="Set min seconds between jstack of a java process (default: 60)")
+parser.add_argument("--sampler", choices=["auto", "proc", "ps"], default="auto", help="Set CPU sampler (default: auto)")
+parser.add_argument("--sort-by", choices=["cpu", "runq-wait", "nvcsw"], default="cpu", help="Set metric to rank threads (default: cpu)")
+parser.add_argument("--proc-root", type=str, default="/proc", help="Set proc filesystem root (default: /proc)")
+parser.add_argument("--self-profile", nargs="?", const="-", type=str, help="Output self-overhead summary as JSON to file or stderr")
+parser.add_argument("--listen", type=str, default="127.0.0.1:9838", help="Set address of serve subcommand (default: 127.0.0.1:9838)")
+# run by socket attach mode as the user of the java process, see dump_threads_by_socket
+parser.add_argument("--attach-helper", type=str, help=argparse.SUPPRESS)
 parser.add_argument("-h", "--help", action="store_true", help="Show help")
 parser.add_argument("-V", "--version", action="store_true", help="Show version")
+parser.add_argument("delay", nargs="?", help="Set update delay")
+parser.add_argument("update_count", nargs="?", help="Set update count")
+
+args = parser.parse_args(sys.argv[2:] if serve_mode else [] if diff_mode else None)
 
-args = parser.parse_args()
+if args.help:
+    usage()
+if args.version:
+    prog_version()
 
 # Set cpu_sample_interval to 0 if --use-ps is specified
 if args.use_ps:
@@ -238,13 +1366,31 @@ if not is_non_negative_float_number(args.cpu_sample_interval):
     die(f"CPU sample interval ({args.cpu_sample_interval}) is not a non-negative float number!")
 
 # Validate update_delay and update_count
-update_delay = float(sys.argv[1]) if len(sys.argv) > 1 else 0
-if not is_non_negative_float_number(update_delay):
-    die(f"Update delay ({update_delay}) is not a non-negative float number!")
-
-update_count = int(sys.argv[2]) if len(sys.argv) > 2 else 0
-if not is_natural_number(update_count):
-    die(f"Update count ({update_count}) is not a natural number!")
+update_delay = 0
+update_count = 1  # without delay argument, run only once
+if args.delay is not None:
+    if not is_non_negative_float_number(args.delay):
+        die(f"Update delay ({args.delay}) is not a non-negative float number!")
+    update_delay = float(args.delay)
+    update_count = 0
+
+if args.update_count is not None:
+    if not is_natural_number(args.update_count):
+        die(f"Update count ({args.update_count}) is not a natural number!")
+    update_count = int(args.update_count)
+
+# Validate serve mode: sample on the cadence of update delay until stopped
+if serve_mode:
+    if args.delay is None:
+        update_delay = 15
+    if update_delay <= args.cpu_sample_interval:
+        die(f"Update delay ({update_delay}) of serve mode is not greater than CPU sample interval ({args.cpu_sample_interval})!")
+    if args.update_count is not None:
+        die("count argument can not be used with serve mode!")
+    update_count = 0
+    listen_host, _, listen_port = args.listen.rpartition(':')
+    if not listen_host or not is_natural_number(listen_port) or int(listen_port) > 65535:
+        die(f"Listen address ({args.listen}) is illegal! Example: 127.0.0.1:9838 or 0.0.0.0:9838")
 
 # Validate pid_list
 if args.pid:
@@ -254,7 +1400,7 @@ if args.pid:
 
 # Check the directory of append-file mode, create if not existed
 if args.append_file:
-    append_file_dir = os.path.dirname(args.append_file)
+    append_file_dir = os.path.dirname(args.append_file) or '.'
     if os.path.exists(args.append_file):
         if not os.path.isfile(args.append_file):
             die(f"{args.append_file} (specified by option -a, for storing run output files) exists but is not a file!")
@@ -276,13 +1422,140 @@ if args.store_dir:
             die(f"Directory {args.store_dir} (specified by option -S, for storing output files) exists but is not writable!")
     else:
         os.makedirs(args.store_dir, exist_ok=True)
+if args.store_max_bytes < 0:
+    die(f"Store max bytes ({args.store_max_bytes}) is not a non-negative integer!")
+
+# Validate jstack collection control
+if args.jstack_workers <= 0:
+    die(f"jstack workers ({args.jstack_workers}) is not a positive integer!")
+if not is_non_negative_float_number(args.jstack_timeout):
+    die(f"jstack timeout ({args.jstack_timeout}) is not a non-negative float number!")
+if not is_non_negative_float_number(args.round_deadline):
+    die(f"Round deadline ({args.round_deadline}) is not a non-negative float number!")
+
+# Validate poor-man's profiler control
+if args.samples <= 0:
+    die(f"jstack samples ({args.samples}) is not a positive integer!")
+if not is_non_negative_float_number(args.sample_gap):
+    die(f"jstack sample gap ({args.sample_gap}) is not a non-negative float number!")
+if args.samples > 1 and args.group_stacks:
+    die("--samples and -g/--group-stacks options can not be used together!")
+if args.format == "jsonl" and (args.samples > 1 or args.group_stacks):
+    die("--format jsonl can not be used with --samples or -g/--group-stacks options!")
+
+# Validate dump control
+if args.no_dump:
+    if args.dump_tid:
+        die("--no-dump and --dump-tid options can not be used together!")
+    if args.samples > 1 or args.group_stacks or args.lock_info or args.folded_file or args.trigger_cpu is not None:
+        die("--no-dump option can not be used with --samples, -g/--group-stacks, -l/--lock-info, --folded-file or --trigger-cpu options!")
+if args.dump_tid:
+    args.dump_tid = args.dump_tid.replace(" ", "")
+    if not is_natural_number_list(args.dump_tid):
+        die(f"Thread ids ({args.dump_tid}) of --dump-tid option are illegal! Example: 42 or 42,99,67")
+    if args.trigger_cpu is not None:
+        die("--dump-tid and --trigger-cpu options can not be used together!")
+
+# Validate round diff
+if args.diff:
+    if update_count == 1:
+        die("--diff option needs more than one round, set delay and count arguments!")
+    if args.format == "jsonl" or args.trigger_cpu is not None:
+        die("--diff option can not be used with --format jsonl or --trigger-cpu options!")
+
+# Validate watch mode control
+dump_trigger = None
+if args.trigger_cpu is not None:
+    if not is_non_negative_float_number(args.trigger_cpu):
+        die(f"Trigger CPU ({args.trigger_cpu}) is not a non-negative float number!")
+    if args.release_cpu is None:
+        args.release_cpu = args.trigger_cpu * 0.8
+    if not is_non_negative_float_number(args.release_cpu) or args.release_cpu > args.trigger_cpu:
+        die(f"Release CPU ({args.release_cpu}) is not a non-negative float number not greater than trigger CPU!")
+    if args.trigger_samples <= 0:
+        die(f"Trigger samples ({args.trigger_samples}) is not a positive integer!")
+    if not is_non_negative_float_number(args.min_dump_interval):
+        die(f"Min dump interval ({args.min_dump_interval}) is not a non-negative float number!")
+    dump_trigger = DumpTrigger(args.trigger_cpu, args.release_cpu, args.trigger_samples, args.min_dump_interval)
+elif args.release_cpu is not None:
+    die("--release-cpu option can only be used with --trigger-cpu option!")
+
+# Open the collapsed stacks output file
+folded_writer = None
+if args.folded_file:
+    try:
+        folded_writer = FoldedStackWriter(args.folded_file)
+    except OSError as e:
+        die(f"Fail to open {args.folded_file} (specified by option --folded-file, for collapsed stacks output): {e.strerror}")
+
+# Open the busy thread CPU history file
+history_store = None
+if args.history_file:
+    if args.history_max_bytes <= 0:
+        die(f"History max bytes ({args.history_max_bytes}) is not a positive integer!")
+    try:
+        history_store = HistoryStore(args.history_file, args.history_max_bytes)
+    except (OSError, ValueError) as e:
+        die(f"Fail to open {args.history_file} (specified by option --history-file, for CPU history): {e}")
+
+# Self-overhead instrumentation, always recorded, and output only by option --self-profile
+self_profile = SelfProfile()
+self_profile_file = args.self_profile
+
+# Check the proc root of the native sampler
+proc_root = args.proc_root
+if args.sampler == "proc" and not os.path.isdir(proc_root):
+    die(f"{proc_root} (specified by option --proc-root, for sampling thread CPU) is not a directory!")
+
+count = args.count
+# serve mode samples all threads for the per-JVM metrics, and exports the top threads of count
+metrics_thread_count = count
+if serve_mode:
+    count = 0
+no_dump = args.no_dump
+round_diff = args.diff
+# the threads to dump by thread id, sampled among all threads to get their CPU usage
+dump_tids = args.dump_tid.split(',') if args.dump_tid else None
+if dump_tids:
+    count = 0
+cpu_sample_interval = args.cpu_sample_interval
+pid_list = args.pid
+append_file = args.append_file
+store_dir = args.store_dir
+force = '-F' if args.force else None
+mix_native_frames = '-m' if args.mix_native_frames else None
+lock_info = '-l' if args.lock_info else None
+attach_mode = args.attach_mode
+jstack_workers = args.jstack_workers
+jstack_timeout = args.jstack_timeout
+round_deadline = args.round_deadline
+profile_samples = args.samples
+profile_sample_gap = args.sample_gap / 1000
+group_stacks = args.group_stacks
+output_format = args.format
+use_proc_sampler = args.sampler == "proc" or (args.sampler == "auto" and is_proc_sampler_available())
+fleet_mode = args.fleet
+# fleet mode: pid -> JvmInfo of the JVMs found by the latest round
+fleet_jvms = {}
+sort_by = args.sort_by
+if sort_by != "cpu" and not use_proc_sampler:
+    die(f"--sort-by {sort_by} option needs the proc sampler, the proc filesystem is not readable or --sampler ps is used!")
+if fleet_mode and not use_proc_sampler:
+    die("--fleet option needs the proc sampler, the proc filesystem is not readable or --sampler ps is used!")
 
 def is_executable(file_path):
     return os.path.isfile(file_path) and os.access(file_path, os.X_OK)
 jstack_path = args.jstack_path
 
+# 0. Serve and no-dump mode sample thread CPU only, diff subcommand reads stored jstack outputs, or thread dump through the HotSpot attach socket, jstack is not needed
+if serve_mode or no_dump or diff_mode:
+    jstack_path = None
+elif args.attach_mode == "socket":
+    if args.force or args.mix_native_frames:
+        die("-F/--force and -m/--mix-native-frames options are not supported by socket attach mode!")
+
 # 1. Check if jstack_path is set by -s option
-if jstack_path:  # Assuming jstack_path is already set from argparse or other logic
+elif jstack_path:  # Assuming jstack_path is already set from argparse or other logic
     if not is_executable(jstack_path):
         die(f"{jstack_path} (set by -s option) is NOT found or NOT executable!", hint=True)
 
@@ -315,33 +1588,89 @@ else:
         die(f"jstack NOT found in PATH!{NL}Use -s option to set jstack path manually.", hint=True)
 
 # Mark jstack_path as readonly (conceptual, Python doesn't have true readonly)
-print(f"Using jstack path: {jstack_path}")
+if jstack_path:
+    print(f"Using jstack path: {jstack_path}", file=sys.stderr if output_format == "jsonl" else sys.stdout)
 
 # Generate a unique identifier for the session
 run_timestamp = datetime.now().strftime("%Y-%m-%d_%H:%M:%S.%f")
 uuid_str = f"{PROG}_{run_timestamp}_{os.getpid()}_{uuid.uuid4().hex}"
 
+# the jstack outputs are written to tmp dir, and removed after the round;
+# with -S option, the artifacts are kept in the compressed packs of the store dir
 tmp_store_dir = f"/tmp/{uuid_str}"
 store_file_prefix = f"{tmp_store_dir}/{run_timestamp}_"
-if store_dir:
-    store_file_prefix = f"{store_dir}/{run_timestamp}_"
 
 os.makedirs(tmp_store_dir, exist_ok=True)
 
+artifact_store = None
+if store_dir:
+    try:
+        artifact_store = ArtifactStore(store_dir, run_timestamp, args.store_max_bytes)
+    except OSError as e:
+        die(f"Fail to create pack file in {store_dir} (specified by option -S, for storing output files): {e.strerror}")
+
+# Open the output files once for the session
+output_file_paths = []
+if append_file:
+    output_file_paths.append(append_file)
+if store_dir:
+    output_file_paths.append(f"{store_dir}/{run_timestamp}_{PROG}_log")
+try:
+    output_sink = OutputSink(output_file_paths, jsonl=output_format == "jsonl")
+except OSError as e:
+    die(f"Fail to open output file {e.filename}: {e.strerror}")
+
 def cleanup_when_exit():
     """Cleanup temporary directories on exit."""
     if os.path.exists(tmp_store_dir):
         subprocess.call(['rm', '-rf', tmp_store_dir])
 
-signal.signal(signal.SIGTERM, lambda signum, frame: cleanup_when_exit())
-signal.signal(signal.SIGINT, lambda signum, frame: cleanup_when_exit())
+atexit.register(cleanup_when_exit)
+
+# the child processes running in sessions of their own (jstack, attach helper), out of the foreground
+# process group of the terminal, so Ctrl-C does not reach them: killed on exit by the tool itself
+child_processes = set()
+child_processes_lock = threading.Lock()
+child_processes_stopped = False
+
+def kill_child_processes():
+    """Kill the running child processes, and stop starting new ones, on exit."""
+    global child_processes_stopped
+    with child_processes_lock:
+        child_processes_stopped = True
+        processes = list(child_processes)
+    for process in processes:
+        kill_process_group(process)
 
-def head_info(timestamp, update_round_num):
+atexit.register(kill_child_processes)
+
+def close_outputs():
+    """Flush and close the buffered output files on exit."""
+    if artifact_store:
+        artifact_store.close()
+    output_sink.close()
+
+atexit.register(close_outputs)
+
+def exit_by_signal(signum, frame):
+    """
+    Exit when interrupted/terminated, by SystemExit raised in the main thread: the run summaries are printed
+    by main on the way out, then the output is flushed and the tmp dir is removed at exit.
+    The child processes are killed first, so that the exit does not wait for a hung jstack.
+    """
+    kill_child_processes()
+    sys.exit(128 + signum)
+
+signal.signal(signal.SIGTERM, exit_by_signal)
+signal.signal(signal.SIGINT, exit_by_signal)
+
+def head_info(timestamp, update_round_num, sample_lag=0.0, output_lag=0.0):
     """Print header information."""
-    print("=" * 80)
-    print(f"{timestamp} [{update_round_num + 1}/{update_count}]: {print_calling_command_line()}")
-    print("=" * 80)
-    print()
+    normal_output("=" * 80)
+    normal_output(f"{timestamp} [{update_round_num + 1}/{update_count}]: {print_calling_command_line()}")
+    normal_output(f"sample lag: {sample_lag * 1000:.1f}ms, output lag: {output_lag * 1000:.1f}ms")
+    normal_output("=" * 80)
+    normal_output("")
 
 def print_calling_command_line():
     """Simulate a function to print the calling command line."""
@@ -349,169 +1678,1622 @@ def print_calling_command_line():
     import sys
     return ' '.join(sys.argv)
 
-def die(message):
-    """Exit the program with an error message."""
-    print(f"Error: {message}")
-    exit(1)
-
-def find_busy_java_threads_by_ps():
+def find_busy_java_threads_by_ps(round_num):
     """Use `ps` to find busy Java threads (by CPU usage)."""
     ps_process_select_options = f"-p {pid_list}" if pid_list else "-C java -C jsvc"
     ps_cmd_line = f"ps {ps_process_select_options} -wwLo 'pid,lwp,pcpu,user' --no-headers"
 
     try:
-        ps_out = subprocess.check_output(ps_cmd_line, shell=True).decode()
+        self_profile.count_fork(round_num)
+        with self_profile.phase(round_num, 'cpu_sampling'):
+            ps_out = subprocess.check_output(ps_cmd_line, shell=True).decode()
         sorted_ps_out = "\n".join(sorted(ps_out.splitlines(), key=lambda x: float(x.split()[2]), reverse=True))
 
-        if store_dir:
-            with open(f"{store_file_prefix}{update_round_num + 1}_ps", 'w') as f:
-                f.write(ps_cmd_line + "\n" + sorted_ps_out)
+        if artifact_store:
+            artifact_store.add_text(round_num, "ps", ps_cmd_line + "\n" + sorted_ps_out)
 
+        busy_threads = [tuple(line.split()[:4]) for line in sorted_ps_out.splitlines()]
         if count > 0:
-            return "\n".join(sorted_ps_out.splitlines()[:count])
+            return busy_threads[:count]
         else:
-            return sorted_ps_out
+            return busy_threads
 
     except subprocess.CalledProcessError:
         die("No Java process found!")
 
-def find_busy_java_threads_by_top():
+def find_busy_java_threads_by_top(round_num):
     """Use `top` to find busy Java threads (by CPU usage)."""
     ps_process_select_options = f"-p {pid_list}" if pid_list else "-C java -C jsvc"
     
     try:
-        java_pid_list = subprocess.check_output(f"ps {ps_process_select_options} -o pid --no-headers", shell=True).decode().strip()
+        self_profile.count_fork(round_num)
+        with self_profile.phase(round_num, 'discovery'):
+            java_pid_list = subprocess.check_output(f"ps {ps_process_select_options} -o pid --no-headers", shell=True).decode().strip()
         if not java_pid_list:
             raise subprocess.CalledProcessError(1, "No Java process found!")
 
         java_pid_list = ",".join(java_pid_list.split())
 
         top_cmd_line = f"top -H -b -d {cpu_sample_interval} -n 2 -p {java_pid_list}"
-        top_out = subprocess.check_output(top_cmd_line, shell=True, env={"HOME": tmp_store_dir}).decode()
-
-        if store_dir:
-            with open(f"{store_file_prefix}{update_round_num + 1}_top", 'w') as f:
-                f.write(top_cmd_line + "\n" + top_out)
-
-        # Parse the output to get thread ID and CPU usage from the second snapshot
-        result_threads_top_info = []
-        block_index = 0
-        previous_line = None
-        for line in top_out.splitlines():
-            if previous_line and not line.strip():
-                block_index += 1
-            if block_index == 3 and line.strip() and line.split()[0].isdigit():
-                result_threads_top_info.append((line.split()[0], line.split()[8]))  # thread ID and %CPU
-            previous_line = line
+        self_profile.count_fork(round_num)
+        with self_profile.phase(round_num, 'cpu_sampling'):
+            top_out = subprocess.check_output(top_cmd_line, shell=True, env={"HOME": tmp_store_dir}).decode()
 
+        if artifact_store:
+            artifact_store.add_text(round_num, "top", top_cmd_line + "\n" + top_out)
+
+        result_threads_top_info = parse_top_output(top_out)
         if not result_threads_top_info:
             die("No Java threads found in `top` output!")
 
-        return sorted(result_threads_top_info, key=lambda x: float(x[1]), reverse=True)
+        return result_threads_top_info
 
     except subprocess.CalledProcessError:
         die("No Java process found!")
 
-def __complete_pid_user_by_ps(threads):
+def parse_top_output(top_out):
+    """
+    Parse the output of `top -H -b -n 2` to get thread ID and CPU usage from the second snapshot,
+    sorted by CPU usage.
+    """
+    result_threads_top_info = []
+    block_index = 0
+    previous_line = None
+    for line in top_out.splitlines():
+        if previous_line and not line.strip():
+            block_index += 1
+        if block_index == 3 and line.strip():
+            fields = line.split()
+            if fields[0].isdigit():
+                result_threads_top_info.append((fields[0], fields[8]))  # thread ID and %CPU
+        previous_line = line
+
+    return sorted(result_threads_top_info, key=lambda x: float(x[1]), reverse=True)
+
+def find_busy_java_threads_by_proc(round_num):
+    """
+    Use the proc filesystem to find busy Java threads (by CPU usage, run queue wait or nonvoluntary context switches),
+    without forking `ps`/`top`. Return (busy threads, dict of (pid, thread id) -> ThreadSchedStats).
+    """
+    global fleet_jvms
+    with self_profile.phase(round_num, 'discovery'):
+        if fleet_mode:
+            # replaced as a whole, the output thread may read the JVMs of previous round meanwhile
+            fleet_jvms = {jvm.pid: jvm for jvm in discover_jvms_by_proc()}
+            java_pids = list(fleet_jvms)
+        else:
+            java_pids = discover_java_pids_by_proc()
+    if not java_pids:
+        die("No Java process found!")
+
+    sampling_start = time.perf_counter()
+    if cpu_sample_interval > 0:
+        # CPU usage and scheduler stats during the sample interval, like `top`
+        before = {pid: read_thread_cpu_ticks(pid) for pid in java_pids}
+        before_sched = {pid: read_thread_sched_stats(pid, before[pid]) for pid in java_pids}
+        before_time = time.monotonic()
+        time.sleep(cpu_sample_interval)
+        after = {pid: read_thread_cpu_ticks(pid) for pid in java_pids}
+        after_sched = {pid: read_thread_sched_stats(pid, after[pid]) for pid in java_pids}
+        elapsed_ticks = (time.monotonic() - before_time) * CLK_TCK
+
+        threads_cpu = []
+        for pid, thread_ticks in after.items():
+            previous_ticks = before.get(pid, {})
+            previous_sched = before_sched.get(pid, {})
+            for tid, (ticks, _) in thread_ticks.items():
+                # thread started during the interval counts from zero
+                delta_ticks = ticks - previous_ticks.get(tid, (0, 0))[0]
+                sched, previous = after_sched[pid].get(tid, NO_SCHED_STATS), previous_sched.get(tid, NO_SCHED_STATS)
+                threads_cpu.append((pid, tid, delta_ticks * 100 / elapsed_ticks,
+                                    ThreadSchedStats(*(value - previous_value for value, previous_value in zip(sched, previous)))))
+    else:
+        # CPU usage during the entire lifetime of the thread, like `ps`; scheduler stats since the thread started
+        uptime_ticks = read_uptime_ticks()
+        threads_cpu = []
+        for pid in java_pids:
+            thread_ticks = read_thread_cpu_ticks(pid)
+            thread_sched = read_thread_sched_stats(pid, thread_ticks)
+            for tid, (ticks, start_ticks) in thread_ticks.items():
+                lifetime_ticks = uptime_ticks - start_ticks
+                threads_cpu.append((pid, tid, ticks * 100 / lifetime_ticks if lifetime_ticks > 0 else 0.0,
+                                    thread_sched.get(tid, NO_SCHED_STATS)))
+
+    self_profile.add(round_num, 'cpu_sampling', time.perf_counter() - sampling_start)
+    if not threads_cpu:
+        die("No Java threads found in proc filesystem!")
+
+    with self_profile.phase(round_num, 'ps_completion'):
+        if fleet_mode:
+            users = {pid: jvm.user for pid, jvm in fleet_jvms.items()}
+        else:
+            users = {pid: read_process_user(pid) for pid in java_pids}
+    # rank by the metric of option --sort-by, ties by CPU usage
+    if sort_by == "runq-wait":
+        threads_cpu.sort(key=lambda x: (x[3].runq_wait_ms, x[2]), reverse=True)
+    elif sort_by == "nvcsw":
+        threads_cpu.sort(key=lambda x: (x[3].nvcsw, x[2]), reverse=True)
+    else:
+        threads_cpu.sort(key=lambda x: x[2], reverse=True)
+    threads_cpu = [thread for thread in threads_cpu if users[thread[0]]]
+    if count > 0:
+        threads_cpu = threads_cpu[:count]
+    busy_threads = [(pid, tid, f"{pcpu:.1f}", users[pid]) for pid, tid, pcpu, _ in threads_cpu]
+    sched_stats = {(pid, tid): sched for pid, tid, _, sched in threads_cpu}
+
+    if artifact_store:
+        artifact_store.add_text(round_num, "proc", f"{proc_root} -i {cpu_sample_interval} --sort-by {sort_by}\n" + "".join(
+            f"{pid} {tid} {pcpu:.1f} {users[pid]} {sched.runq_wait_ms:.3f} {sched.nvcsw} {sched.vcsw}\n"
+            for pid, tid, pcpu, sched in threads_cpu))
+
+    return busy_threads, sched_stats
+
+def find_busy_java_threads(round_num):
+    """
+    Find busy Java threads by the native proc sampler, fallback to `ps`/`top`.
+    Return (busy threads, dict of (pid, thread id) -> ThreadSchedStats), scheduler stats only by the proc sampler.
+    """
+    if use_proc_sampler:
+        return find_busy_java_threads_by_proc(round_num)
+    if cpu_sample_interval == 0:
+        return find_busy_java_threads_by_ps(round_num), {}
+    busy_threads = __complete_pid_user_by_ps(find_busy_java_threads_by_top(round_num), round_num)
+    if count > 0:
+        busy_threads = busy_threads[:count]
+    return busy_threads, {}
+
+def __complete_pid_user_by_ps(threads, round_num):
     """Complete PID and user information using `ps`."""
     ps_process_select_options = f"-p {pid_list}" if pid_list else "-C java -C jsvc"
     ps_cmd_line = f"ps {ps_process_select_options} -wwLo 'pid,lwp,user' --no-headers"
 
     try:
-        ps_out = subprocess.check_output(ps_cmd_line, shell=True).decode()
-
-        if store_dir:
-            with open(f"{store_file_prefix}{update_round_num + 1}_ps", 'w') as f:
-                f.write(ps_cmd_line + "\n" + ps_out)
-
-        results = []
-        for thread_id, pcpu in threads:
-            for line in ps_out.splitlines():
-                pid, lwp, user = line.split()[:3]
-                if lwp == thread_id:
-                    results.append((pid, lwp, pcpu, user))
-                    break
+        self_profile.count_fork(round_num)
+        with self_profile.phase(round_num, 'ps_completion'):
+            ps_out = subprocess.check_output(ps_cmd_line, shell=True).decode()
 
-        return results
+        if artifact_store:
+            artifact_store.add_text(round_num, "ps", ps_cmd_line + "\n" + ps_out)
+
+        return complete_pid_user(threads, ps_out)
 
     except subprocess.CalledProcessError:
         die("No Java process found!")
 
-def print_stack_of_threads(threads):
-    """Print the stack trace of busy threads using `jstack`."""
+def complete_pid_user(threads, ps_out):
+    """
+    Complete PID and user information of the threads (thread ID, %CPU) by the output of `ps -wwLo 'pid,lwp,user'`.
+    """
+    # index ps lines by lwp once, instead of scanning all ps lines for each thread
+    lwp_pid_users = {}
+    for line in ps_out.splitlines():
+        pid, lwp, user = line.split()[:3]
+        lwp_pid_users.setdefault(lwp, (pid, user))
+
+    results = []
+    for thread_id, pcpu in threads:
+        pid_user = lwp_pid_users.get(thread_id)
+        if pid_user is not None:
+            results.append((pid_user[0], thread_id, pcpu, pid_user[1]))
+    return results
+
+# nid of thread header line, hex before JDK 19 (nid=0x3039), decimal since JDK 19 (nid=12345)
+JSTACK_NID_PATTERN = re.compile(rb'\bnid=(0x[0-9a-fA-F]+|[0-9]+)')
+# new line before a line which is not indented, the boundary of thread blocks;
+# searched by the leading literal new line, much faster than a `^` pattern of MULTILINE
+JSTACK_BLOCK_BOUNDARY_PATTERN = re.compile(rb'\n(?![ \t\r\n])')
+# lock lines of jstack -l output: a monitor/synchronizer the thread holds or waits for,
+# the lines in `Locked ownable synchronizers:` section have no verb
+JSTACK_LOCK_PATTERN = re.compile(
+    rb'^\s+- (?:(locked|waiting to lock|waiting to re-lock in wait\(\)|waiting on|parking to wait for) +)?'
+    rb'<(0x[0-9a-fA-F]+)> \(a ([^)]+)\)')
+# the lock verbs of a thread blocked by the holder of the lock
+JSTACK_LOCK_WAIT_VERBS = (b'waiting to lock', b'waiting to re-lock in wait()', b'parking to wait for')
+# the lock verbs of a monitor released in Object.wait(), though listed as locked in the caller frame
+JSTACK_LOCK_RELEASED_VERBS = (b'waiting on', b'waiting to re-lock in wait()')
+
+class JstackDumpIndex:
+    """
+    Index of a stored jstack output file from thread nid to the byte offsets of the thread block.
+
+    The file is read once by a streaming parser when the index is built,
+    then the thread blocks are read from the file on demand.
+    With parse_locks, the lock lines of jstack -l output are indexed in the same pass.
+    """
+
+    def __init__(self, jstack_file, parse_locks=False):
+        self.jstack_file = jstack_file
+        self.nid_offsets = {}
+        self.reader = None
+        # lock address -> nid of the holder thread
+        self.lock_owners = {}
+        # nid -> lock address the thread is blocked on
+        self.lock_waits = {}
+        # lock address -> class name of the lock
+        self.lock_classes = {}
+        # nid -> thread name, of the threads with lock lines only
+        self.thread_names = {}
+
+        with open(jstack_file, 'rb') as f:
+            offset = 0
+            block_nid = None
+            block_start = 0
+            block_header = b''
+            block_locks = []
+            for line in f:
+                # a thread block starts with the quoted thread name, and ends before the next
+                # line that is not indented (next thread, `JNI global refs`, deadlock report)
+                if line[:1] not in (b' ', b'\t', b'\r', b'\n'):
+                    if block_nid is not None:
+                        self.nid_offsets[block_nid] = (block_start, offset)
+                        if block_locks:
+                            self._index_locks(block_nid, block_header, block_locks)
+                            block_locks = []
+                        block_nid = None
+                    if line.startswith(b'"'):
+                        match = JSTACK_NID_PATTERN.search(line)
+                        if match:
+                            block_nid = int(match.group(1), 0)
+                            block_start = offset
+                            block_header = line
+                # lock lines are the `\t- ...` lines, the deadlock report of jstack repeats them outside thread blocks
+                elif parse_locks and line[1:2] == b'-' and block_nid is not None:
+                    match = JSTACK_LOCK_PATTERN.match(line)
+                    if match:
+                        block_locks.append(match.groups())
+                offset += len(line)
+            if block_nid is not None:
+                self.nid_offsets[block_nid] = (block_start, offset)
+                if block_locks:
+                    self._index_locks(block_nid, block_header, block_locks)
+
+    def _index_locks(self, nid, header, locks):
+        """Index the lock lines, as (verb, address, class), of a thread block."""
+        # a monitor in Object.wait() is released, though jstack lists it as locked in the caller frame,
+        # also when the thread is notified and waits to re-lock it
+        released = {address for verb, address, _ in locks if verb in JSTACK_LOCK_RELEASED_VERBS}
+        for verb, address, lock_class in locks:
+            lock_address = address.decode()
+            self.lock_classes[lock_address] = lock_class.decode(errors='replace')
+            if verb is None or verb == b'locked':
+                if address not in released:
+                    self.lock_owners[lock_address] = nid
+            elif verb in JSTACK_LOCK_WAIT_VERBS:
+                self.lock_waits[nid] = lock_address
+        self.thread_names[nid] = parse_thread_name(header.decode(errors='replace'))
+
+    def thread_block(self, thread_id):
+        """
+        Return the stack section of the thread from the jstack output, None if not found.
+        """
+        offsets = self.nid_offsets.get(int(thread_id))
+        if offsets is None:
+            return None
+        start, end = offsets
+        # keep the file open, the blocks of thousands of threads may be read
+        if self.reader is None:
+            self.reader = open(self.jstack_file, 'rb')
+        self.reader.seek(start)
+        return self.reader.read(end - start).decode(errors='replace').rstrip()
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+            self.reader = None
+
+class LockGraph:
+    """
+    Waits-for graph of the threads of a jstack -l output: an edge from a blocked thread
+    to the holder of the monitor/synchronizer it waits for.
+
+    A thread waits for at most one lock, so the graph is a functional graph (out-degree <= 1):
+    each thread is walked once to find the deadlock cycles, and the distance to the end of its
+    blocking chain (a holder not blocked, or a cycle), in linear time of the thread count.
+    """
+
+    def __init__(self, jstack_index):
+        # nid -> nid of the holder thread of the lock the thread waits for
+        self.next_nids = {}
+        for nid, address in jstack_index.lock_waits.items():
+            owner = jstack_index.lock_owners.get(address)
+            if owner is not None and owner != nid:
+                self.next_nids[nid] = owner
+
+        self.cycles = []
+        # nid -> the end of blocking chain of the thread, and the distance to it
+        self.chain_ends = {}
+        self.depths = {}
+        for start in self.next_nids:
+            if start in self.depths:
+                continue
+            path = []
+            on_path = set()
+            nid = start
+            while nid in self.next_nids and nid not in self.depths and nid not in on_path:
+                path.append(nid)
+                on_path.add(nid)
+                nid = self.next_nids[nid]
+            if nid in on_path:
+                # deadlock, the chains into the cycle end at its entry thread
+                cycle = path[path.index(nid):]
+                del path[-len(cycle):]
+                self.cycles.append(cycle)
+                for cycle_nid in cycle:
+                    self.chain_ends[cycle_nid] = cycle_nid
+                    self.depths[cycle_nid] = 0
+            elif nid not in self.depths:
+                # holder which is not blocked
+                self.chain_ends[nid] = nid
+                self.depths[nid] = 0
+            for path_nid in reversed(path):
+                next_nid = self.next_nids[path_nid]
+                self.chain_ends[path_nid] = self.chain_ends[next_nid]
+                self.depths[path_nid] = self.depths[next_nid] + 1
+
+    def blocked_count(self):
+        """Return the count of threads blocked by a holder thread, besides the threads in deadlocks."""
+        return sum(1 for depth in self.depths.values() if depth > 0)
+
+    def blocking_chains(self):
+        """
+        Return the blocking chains as list of (blocked thread count, longest chain of nids),
+        one for each end of chains, ordered by blocked thread count.
+        The chain starts with the most distant blocked thread, and ends at the holder not blocked,
+        or the entry thread of a deadlock cycle.
+        """
+        # end nid -> [blocked count, most distant blocked nid]
+        chain_stats = {}
+        for nid, depth in self.depths.items():
+            if depth == 0:
+                continue
+            stat = chain_stats.setdefault(self.chain_ends[nid], [0, nid])
+            stat[0] += 1
+            if depth > self.depths[stat[1]]:
+                stat[1] = nid
+        chains = []
+        for end_nid, (blocked_count, nid) in chain_stats.items():
+            chain = [nid]
+            while nid != end_nid:
+                nid = self.next_nids[nid]
+                chain.append(nid)
+            chains.append((blocked_count, chain))
+        chains.sort(key=lambda chain: (chain[0], len(chain[1])), reverse=True)
+        return chains
+
+class AttachError(Exception):
+    """Failure of thread dump through the HotSpot attach socket."""
+
+ATTACH_PROTOCOL_VERSION = b"1"
+# max arguments count of an attach command
+ATTACH_ARG_COUNT_MAX = 3
+
+def read_process_nspid(pid):
+    """
+    Read the pid of the process in its own pid namespace (the last one of NSpid in /proc/<pid>/status),
+    the attach socket of a containerized JVM is named by this pid.
+    """
+    status = read_proc_file(pid, 'status')
+    if status is not None:
+        for line in status.splitlines():
+            if line.startswith('NSpid:'):
+                return line.split()[-1]
+    return pid
+
+def start_attach_listener(pid, nspid, socket_path, deadline):
+    """
+    Trigger the attach listener of the JVM: create the attach file `.attach_pid<pid>`
+    then send SIGQUIT to the JVM, and wait for the attach socket to be created.
+    """
+    attach_file = None
+    for attach_file_dir in (os.path.join(proc_root, pid, 'cwd'), os.path.join(proc_root, pid, 'root', 'tmp')):
+        path = os.path.join(attach_file_dir, f".attach_pid{nspid}")
+        try:
+            open(path, 'w').close()
+            attach_file = path
+            break
+        except OSError:
+            continue
+    if attach_file is None:
+        raise AttachError(f"fail to create attach file of java process({pid})")
+
+    try:
+        # the pids under a proc root other than /proc (e.g. a fixture tree) are not processes of this host
+        if proc_root == '/proc':
+            os.kill(int(pid), signal.SIGQUIT)
+        while not os.path.exists(socket_path):
+            if time.monotonic() >= deadline:
+                raise AttachError(f"attach listener of java process({pid}) is not started, socket {socket_path} not found")
+            time.sleep(0.05)
+    finally:
+        try:
+            os.remove(attach_file)
+        except OSError:
+            pass
+
+def attach_thread_dump(pid, out_fd, timeout):
+    """
+    Request the thread dump of the JVM through the HotSpot dynamic attach protocol,
+    and stream the reply to the file descriptor.
+    """
+    deadline = time.monotonic() + timeout if timeout is not None else float('inf')
+    nspid = read_process_nspid(pid)
+    socket_path = os.path.join(proc_root, pid, 'root', 'tmp', f".java_pid{nspid}")
+    if not os.path.exists(socket_path):
+        start_attach_listener(pid, nspid, socket_path, deadline)
+
+    # request: <version>\0<command>\0<arg0>\0<arg1>\0<arg2>\0
+    command_args = [lock_info or ""] + [""] * (ATTACH_ARG_COUNT_MAX - 1)
+    request = b"\0".join([ATTACH_PROTOCOL_VERSION, b"threaddump"] + [arg.encode() for arg in command_args]) + b"\0"
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        sock.settimeout(timeout)
+        try:
+            sock.connect(socket_path)
+            sock.sendall(request)
+            # reply: <return code>\n<output of command>
+            reply = b""
+            while b"\n" not in reply:
+                data = sock.recv(8192)
+                if not data:
+                    raise AttachError(f"attach socket of java process({pid}) closed without reply")
+                reply += data
+            return_code, reply = reply.split(b"\n", 1)
+            if return_code.strip() != b"0":
+                raise AttachError(f"attach command threaddump of java process({pid}) "
+                                  f"fail with code {return_code.decode(errors='replace')}: "
+                                  f"{reply.decode(errors='replace').strip()}")
+            while reply:
+                os.write(out_fd, reply)
+                reply = sock.recv(65536)
+        except socket.timeout:
+            raise AttachError(f"attach socket timeout({timeout:.1f}s)")
+        except OSError as e:
+            raise AttachError(f"attach socket of java process({pid}) error: {e}")
+
+def dump_threads_by_socket(pid, user, jstack_file, timeout, round_num):
+    """
+    Thread dump of the java process through the attach socket, save the output to the file.
+    The JVM only accepts the peer with the same effective uid/gid, so run the attach helper
+    (this script with the hidden option --attach-helper) as the user of the java process like `sudo -u`,
+    when it is not the current user.
+    Return None if succeed, otherwise the failure reason.
+    """
+    with open(jstack_file, 'wb') as f:
+        if user == WHOAMI:
+            try:
+                attach_thread_dump(pid, f.fileno(), timeout)
+                return None
+            except AttachError as e:
+                return str(e)
+
+        # by the numeric ids of the process, the uid of a container JVM may have no passwd entry
+        ids = read_process_ids(pid)
+        if ids is None:
+            return "java process may have exited"
+        uid, gid = ids
+        try:
+            groups = os.getgrouplist(pwd.getpwuid(uid).pw_name, gid)
+        except KeyError:
+            groups = [gid]
+        helper_cmd_line = [sys.executable, os.path.abspath(__file__), '--attach-helper', pid, '--attach-mode', 'socket',
+                           '--proc-root', proc_root, '--jstack-timeout', str(timeout or 0)]
+        if lock_info:
+            helper_cmd_line.append(lock_info)
+        try:
+            self_profile.count_fork(round_num)
+            returncode, error = run_in_process_group(helper_cmd_line, timeout, stdout=f, stderr=subprocess.PIPE,
+                                                     user=uid, group=gid, extra_groups=groups)
+        except subprocess.TimeoutExpired:
+            return f"attach socket timeout({timeout:.1f}s)"
+        except OSError as e:
+            return f"attach helper fail to run: {e}"
+        if returncode != 0:
+            return error.decode(errors='replace').strip() or f"attach helper exit status {returncode}"
+        return None
+
+def attach_helper_main():
+    """
+    The hidden option --attach-helper <pid>: thread dump of the java process through the attach socket
+    to stdout, run by dump_threads_by_socket as the user of the java process.
+    The failure reason is written to stderr.
+    """
+    timeout = jstack_timeout if jstack_timeout > 0 else None
+    try:
+        attach_thread_dump(args.attach_helper, sys.stdout.fileno(), timeout)
+    except AttachError as e:
+        print(e, file=sys.stderr)
+        return 1
+    return 0
+
+# thread name of thread header line: "name" #1 prio=5 ...
+JSTACK_THREAD_NAME_PATTERN = re.compile(r'^"(.*)"')
+
+def parse_thread_name(thread_block):
+    """Parse the thread name from the header line of a thread block."""
+    match = JSTACK_THREAD_NAME_PATTERN.match(thread_block)
+    return match.group(1) if match else ""
+
+def parse_thread_frames(thread_block):
+    """
+    Parse the frames (`at ...` lines) of a thread block, top frame first.
+    The frame strings are interned, so the same frame of many threads/samples is stored once.
+    """
+    frames = []
+    for line in thread_block.splitlines():
+        line = line.strip()
+        if line.startswith('at '):
+            frames.append(sys.intern(line[3:]))
+    return frames
+
+JSTACK_THREAD_STATE_PREFIX = 'java.lang.Thread.State: '
+# hex addresses in frames, e.g. lambda class `Foo$$Lambda$14/0x0000000800066840.run`
+FRAME_ADDRESS_PATTERN = re.compile(r'0x[0-9a-fA-F]+')
+
+_normalized_frames = {}
+
+def parse_thread_state(thread_block):
+    """Parse the thread state (e.g. RUNNABLE, `WAITING (parking)`) of a thread block, empty for VM threads."""
+    start = thread_block.find(JSTACK_THREAD_STATE_PREFIX)
+    if start < 0:
+        return ""
+    start += len(JSTACK_THREAD_STATE_PREFIX)
+    end = thread_block.find('\n', start)
+    return thread_block[start:end if end >= 0 else len(thread_block)].strip()
+
+def stack_hash(state, frames):
+    """
+    Hash of the normalized stack of a thread, as 64-bit unsigned int.
+    The hash is stable across runs and java processes: hex addresses in frames are normalized,
+    and lock lines (`- locked <0x...>`) are not part of the frames.
+    """
+    parts = [state.encode()]
+    for frame in frames:
+        # frames are interned, so normalization is cached and computed once per distinct frame
+        normalized = _normalized_frames.get(frame)
+        if normalized is None:
+            normalized = _normalized_frames[frame] = FRAME_ADDRESS_PATTERN.sub('0x', frame).encode()
+        parts.append(normalized)
+    return int.from_bytes(hashlib.blake2b(b'\n'.join(parts), digest_size=8).digest(), 'big')
+
+# the top frames of a stack kept for the round diff
+DIFF_TOP_FRAMES = 3
+
+# stack of a busy thread found in jstack output, stack hash 0 if not found (e.g. no-dump mode)
+ThreadStack = collections.namedtuple('ThreadStack', 'stack_hash thread_name top_frames')
+NO_THREAD_STACK = ThreadStack(0, "", ())
+
+def parse_thread_stack(thread_block, frames):
+    """Parse the ThreadStack of a thread block, with its parsed frames."""
+    return ThreadStack(stack_hash(parse_thread_state(thread_block), frames), parse_thread_name(thread_block),
+                       tuple(frames[:DIFF_TOP_FRAMES]))
+
+def frame_method(frame):
+    """The method of the frame, without the source location: `java.lang.Thread.run(Thread.java:833)` -> `java.lang.Thread.run`."""
+    return sys.intern(frame.split('(', 1)[0])
+
+# failure reason of jstack when the java process is run by another user and current user is not root
+JSTACK_NEED_SUDO = "need sudo"
+
+# grace time of a timed-out jstack process group to exit on SIGTERM, before SIGKILL
+KILL_GRACE_SECONDS = 1
+
+def kill_process_group(process):
+    """
+    Kill the process started in a new session with its process group: SIGTERM first, which sudo relays
+    to its command even if the command runs in a pty session of its own, then SIGKILL the rest of the group.
+    """
+    try:
+        os.killpg(process.pid, signal.SIGTERM)
+        try:
+            process.wait(KILL_GRACE_SECONDS)
+        except subprocess.TimeoutExpired:
+            pass
+        os.killpg(process.pid, signal.SIGKILL)
+    except ProcessLookupError:
+        pass
+    process.wait()
+
+def run_in_process_group(args, timeout, **popen_args):
+    """
+    Run the command in a new session, so that its process group can be killed as a whole,
+    e.g. the jstack run by sudo which can not relay SIGKILL to it.
+    Return (exit status, stderr output if stderr is subprocess.PIPE otherwise None);
+    on timeout the process group is killed, and TimeoutExpired raised.
+    The process is killed on exit of the tool too, see kill_child_processes.
+    """
+    with child_processes_lock:
+        if child_processes_stopped:
+            raise InterruptedError("exiting, not started")
+        process = subprocess.Popen(args, start_new_session=True, **popen_args)
+        child_processes.add(process)
+    try:
+        with process:
+            try:
+                _, error = process.communicate(timeout=timeout)
+            except subprocess.TimeoutExpired:
+                kill_process_group(process)
+                raise
+        return process.returncode, error
+    finally:
+        with child_processes_lock:
+            child_processes.discard(process)
+
+def jstack_java_process(pid, user, jstack_file, deadline, round_num):
+    """
+    Run jstack for the java process and save the output to the file.
+    Return None if succeed, otherwise the failure reason.
+    """
+    timeout = jstack_timeout if jstack_timeout > 0 else None
+    if deadline is not None:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return f"round deadline({round_deadline}s) exceeded before jstack started"
+        timeout = remaining if timeout is None else min(timeout, remaining)
+
+    if user != WHOAMI and os.geteuid() != 0:
+        return JSTACK_NEED_SUDO
+
+    if attach_mode == "socket":
+        failure = dump_threads_by_socket(pid, user, jstack_file, timeout, round_num)
+        if failure and os.path.exists(jstack_file):
+            os.remove(jstack_file)
+        return failure
+
+    jstack_cmd_line = [arg for arg in [jstack_path, force, mix_native_frames, lock_info, pid] if arg]
+    if user != WHOAMI:
+        jstack_cmd_line = ['sudo', '-u', user] + jstack_cmd_line
+
+    try:
+        self_profile.count_fork(round_num)
+        with open(jstack_file, 'w') as f:
+            returncode, _ = run_in_process_group(jstack_cmd_line, timeout, stdout=f)
+        if returncode == 0:
+            return None
+        failure = f"jstack exit status {returncode}"
+    except subprocess.TimeoutExpired:
+        failure = f"jstack timeout({timeout:.1f}s)"
+    except OSError as e:
+        failure = f"jstack fail to run: {e}"
+    if os.path.exists(jstack_file):
+        os.remove(jstack_file)
+    return failure
+
+def round_deadline_time():
+    """Return the monotonic time of the deadline of all jstack runs of a round starting now, None if no deadline."""
+    return time.monotonic() + round_deadline if round_deadline > 0 else None
+
+def collect_jstack_dumps(threads, round_num, deadline, sample_num=None):
+    """
+    Collect the jstack output of the distinct java processes of busy threads,
+    by a bounded worker pool so that a slow or hung java process does not block the others.
+    Return dict of pid -> (jstack file, failure reason or None).
+    """
+    pid_users = {}
+    for pid, _, _, user in threads:
+        pid_users.setdefault(pid, user)
+
+    def timed_jstack_java_process(pid, user, jstack_file):
+        start = time.perf_counter()
+        try:
+            return jstack_java_process(pid, user, jstack_file, deadline, round_num)
+        finally:
+            self_profile.add_jstack_pid(round_num, pid, time.perf_counter() - start)
+
+    dumps = {}
+    with self_profile.phase(round_num, 'jstack'):
+        executor = concurrent.futures.ThreadPoolExecutor(max_workers=jstack_workers)
+        try:
+            futures = {}
+            for pid, user in pid_users.items():
+                jstack_file = f"{store_file_prefix}{round_num + 1}_jstack_{pid}"
+                if sample_num is not None:
+                    jstack_file += f"_{sample_num + 1}"
+                if os.path.isfile(jstack_file):
+                    dumps[pid] = (jstack_file, None)
+                else:
+                    futures[pid] = (jstack_file, executor.submit(timed_jstack_java_process, pid, user, jstack_file))
+            # every jstack run is bounded by the per-pid timeout and round deadline, so waiting is bounded too
+            for pid, (jstack_file, future) in futures.items():
+                dumps[pid] = (jstack_file, future.result())
+        except BaseException:
+            # interrupted: the running jstack processes are killed by the signal handler,
+            # do not wait for them, nor start the queued ones
+            executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        executor.shutdown()
+    if artifact_store:
+        for pid, (jstack_file, _) in futures.items():
+            if dumps[pid][1] is None:
+                name = f"jstack_{pid}" if sample_num is None else f"jstack_{pid}_{sample_num + 1}"
+                artifact_store.add_dump(round_num, name, jstack_file)
+    return dumps
+
+def index_jstack_dump(jstack_file, round_num, parse_locks=False):
+    """Build the nid index of the jstack output file, measured as parsing phase."""
+    with self_profile.phase(round_num, 'parsing'):
+        return JstackDumpIndex(jstack_file, parse_locks)
+
+LOCK_CHAINS_MAX = 5
+
+def print_lock_contention(jstack_indexes, threads, round_num):
+    """
+    Print the deadlocks and the longest blocking chains of each java process from its jstack -l output,
+    naming the busy threads which hold the contended locks.
+    """
+    busy_thread_of_nids = collections.defaultdict(dict)
+    for pid, thread_id, pcpu, _ in threads:
+        busy_thread_of_nids[pid][int(read_thread_nstid(pid, thread_id))] = (thread_id, pcpu)
+
+    for pid, jstack_index in jstack_indexes.items():
+        with self_profile.phase(round_num, 'parsing'):
+            lock_graph = LockGraph(jstack_index)
+            chains = lock_graph.blocking_chains()
+        if not chains and not lock_graph.cycles:
+            continue
+
+        def thread_desc(nid):
+            name = f"\"{jstack_index.thread_names.get(nid, '')}\"(nid {nid:#x})"
+            busy_thread = busy_thread_of_nids[pid].get(nid)
+            if busy_thread is None:
+                return name
+            thread_id, pcpu = busy_thread
+            return f"busy({pcpu}%) thread({thread_id}/{int(thread_id):x}) {name}"
+
+        def wait_desc(nid):
+            address = jstack_index.lock_waits[nid]
+            return f"waits <{address}> (a {jstack_index.lock_classes[address]}) held by"
+
+        normal_output(f"Lock contention of java process({pid}){jvm_identity(pid)}: "
+                      f"{lock_graph.blocked_count()} thread(s) blocked, {len(lock_graph.cycles)} deadlock(s).")
+        for cycle in lock_graph.cycles:
+            normal_output(f"  deadlock of {len(cycle)} threads:")
+            for nid in cycle:
+                normal_output(f"    {thread_desc(nid)} {wait_desc(nid)} {thread_desc(lock_graph.next_nids[nid])}")
+        for blocked_count, chain in chains[:LOCK_CHAINS_MAX]:
+            end_nid = chain[-1]
+            end_state = "in deadlock" if end_nid in lock_graph.next_nids else "not blocked"
+            normal_output(f"  {blocked_count} thread(s) blocked behind {thread_desc(end_nid)} ({end_state}), "
+                          f"longest chain of {len(chain)} threads:")
+            for nid in chain[:-1]:
+                normal_output(f"    {thread_desc(nid)} {wait_desc(nid)}")
+            normal_output(f"    {thread_desc(end_nid)}")
+        normal_output("")
+
+def jvm_identity(pid):
+    """Format the container and namespace pid of the java process in fleet mode, empty otherwise."""
+    jvm = fleet_jvms.get(pid)
+    if jvm is None:
+        return ""
+    container = f"container({jvm.container_id[:12]})" if jvm.container_id else f"cgroup({jvm.cgroup})"
+    return f" in {container} as pid({jvm.nspid})"
+
+def format_sched_stats(sched_stats, pid, thread_id):
+    """Format the scheduler stats of the thread sampled by the proc sampler, empty otherwise."""
+    sched = sched_stats.get((pid, thread_id)) if sched_stats else None
+    if sched is None:
+        return ""
+    return f", runq-wait({sched.runq_wait_ms:.1f}ms) nvcsw({sched.nvcsw}) vcsw({sched.vcsw})"
+
+def print_jstack_failure(idx, pid, thread_id, pcpu, user, failure, sched_stats=None):
+    """Print the failure of jstack for the busy thread."""
+    thread_id_hex = format(int(thread_id), 'x')
+    if failure == JSTACK_NEED_SUDO:
+        normal_output(f"[{idx}] Fail to jstack busy({pcpu}%) thread({thread_id}/{thread_id_hex}) "
+              f"stack of java process({pid}){jvm_identity(pid)} under user({user})"
+              f"{format_sched_stats(sched_stats, pid, thread_id)}.")
+        normal_output(f"User of java process({user}) is not current user({WHOAMI}), need sudo to rerun:")
+        normal_output(f"    sudo {print_calling_command_line()}")
+    else:
+        normal_output(f"[{idx}] Failed to jstack busy({pcpu}%) thread({thread_id}/{thread_id_hex}) "
+              f"stack of java process({pid}){jvm_identity(pid)} under user({user})"
+              f"{format_sched_stats(sched_stats, pid, thread_id)}: {failure}.")
+
+def busy_thread_record(round_num, timestamp, pid, thread_id, pcpu, user, sched_stats=None):
+    """The jsonl record of a busy thread, with the container identity in fleet mode and the scheduler stats if sampled."""
+    record = {'round': round_num + 1, 'timestamp': timestamp, 'pid': int(pid), 'tid': int(thread_id),
+              'nid': f"0x{int(thread_id):x}", 'pcpu': float(pcpu), 'user': user}
+    jvm = fleet_jvms.get(pid)
+    if jvm is not None:
+        record.update(container_id=jvm.container_id, cgroup=jvm.cgroup, nspid=int(jvm.nspid))
+    sched = sched_stats.get((pid, thread_id)) if sched_stats else None
+    if sched is not None:
+        record.update(runq_wait_ms=round(sched.runq_wait_ms, 3), nvcsw=sched.nvcsw, vcsw=sched.vcsw)
+    return record
+
+def print_stack_of_threads(threads, round_num, timestamp=None, sched_stats=None):
+    """
+    Print the stack trace of busy threads using `jstack`, or a record of each busy thread in jsonl format.
+    Return dict of (pid, thread id) -> ThreadStack of the busy threads found in jstack output.
+    """
+    dumps = collect_jstack_dumps(threads, round_num, round_deadline_time())
+    # the jstack output of each java process is parsed once, and reused by all its busy threads
+    jstack_indexes = {}
+    thread_stacks = {}
     idx = 0
     for pid, thread_id, pcpu, user in threads:
         idx += 1
         thread_id_hex = format(int(thread_id), 'x')
 
-        jstack_file = f"{store_file_prefix}{update_round_num + 1}_jstack_{pid}"
-        if not os.path.isfile(jstack_file):
-            jstack_cmd_line = [jstack_path, force, mix_native_frames, lock_info, pid]
-            try:
-                if user == WHOAMI:
-                    with open(jstack_file, 'w') as f:
-                        subprocess.run(jstack_cmd_line, stdout=f, check=True)
-                elif os.geteuid() == 0:
-                    with open(jstack_file, 'w') as f:
-                        subprocess.run(['sudo', '-u', user] + jstack_cmd_line, stdout=f, check=True)
-                else:
-                    print(f"[{idx}] Fail to jstack busy({pcpu}%) thread({thread_id}/{thread_id_hex}) "
-                          f"stack of java process({pid}) under user({user}).")
-                    print(f"User of java process({user}) is not current user({WHOAMI}), need sudo to rerun:")
-                    print(f"    sudo {' '.join(print_calling_command_line())}")
-                    continue
-            except subprocess.CalledProcessError:
-                print(f"[{idx}] Failed to jstack busy({pcpu}%) thread({thread_id}/{thread_id_hex}) "
-                      f"stack of java process({pid}) under user({user}).")
-                if os.path.exists(jstack_file):
-                    os.remove(jstack_file)
+        jstack_file, failure = dumps[pid]
+        if output_format == "jsonl":
+            record = busy_thread_record(round_num, timestamp, pid, thread_id, pcpu, user, sched_stats)
+        if failure:
+            if output_format == "jsonl":
+                record['error'] = failure
+                output_sink.write_record(record)
+            else:
+                print_jstack_failure(idx, pid, thread_id, pcpu, user, failure, sched_stats)
+            continue
+
+        if pid not in jstack_indexes:
+            jstack_indexes[pid] = index_jstack_dump(jstack_file, round_num, parse_locks=lock_info is not None)
+        thread_block = jstack_indexes[pid].thread_block(read_thread_nstid(pid, thread_id))
+
+        if output_format == "jsonl":
+            if thread_block is None:
+                record['error'] = "not found in jstack output, may have exited"
+            else:
+                with self_profile.phase(round_num, 'parsing'):
+                    frames = parse_thread_frames(thread_block)
+                    thread_stack = thread_stacks[(pid, thread_id)] = parse_thread_stack(thread_block, frames)
+                    record['thread_name'] = thread_stack.thread_name
+                    record['frames'] = frames
+                if folded_writer:
+                    folded_writer.add(frames, float(pcpu))
+            output_sink.write_record(record)
+            continue
+
+        normal_output(f"[{idx}] Busy({pcpu}%) thread({thread_id}/{thread_id_hex}) stack of java process({pid}){jvm_identity(pid)} under user({user})"
+                      f"{format_sched_stats(sched_stats, pid, thread_id)}:")
+        if thread_block is None:
+            normal_output(f"thread({thread_id}/{thread_id_hex}) is NOT found in jstack output, may have exited.")
+        else:
+            normal_output(thread_block)
+            with self_profile.phase(round_num, 'parsing'):
+                frames = parse_thread_frames(thread_block)
+                thread_stacks[(pid, thread_id)] = parse_thread_stack(thread_block, frames)
+            if folded_writer:
+                folded_writer.add(frames, float(pcpu))
+        normal_output("")
+    if lock_info:
+        print_lock_contention(jstack_indexes, threads, round_num)
+    for jstack_index in jstack_indexes.values():
+        jstack_index.close()
+    return thread_stacks
+
+def print_busy_threads(threads, round_num, timestamp=None, sched_stats=None):
+    """
+    Print the busy threads with thread name from the proc filesystem, without jstack (no-dump mode),
+    or a record of each busy thread in jsonl format.
+    Return dict of (pid, thread id) -> ThreadStack of the busy threads, with thread name only.
+    """
+    with self_profile.phase(round_num, 'parsing'):
+        thread_names = [read_thread_name(pid, thread_id) for pid, thread_id, _, _ in threads]
+    for idx, ((pid, thread_id, pcpu, user), thread_name) in enumerate(zip(threads, thread_names), 1):
+        thread_id_hex = format(int(thread_id), 'x')
+        if output_format == "jsonl":
+            record = busy_thread_record(round_num, timestamp, pid, thread_id, pcpu, user, sched_stats)
+            record['thread_name'] = thread_name
+            output_sink.write_record(record)
+            continue
+        normal_output(f"[{idx}] Busy({pcpu}%) thread({thread_id}/{thread_id_hex}) \"{thread_name}\" "
+                      f"of java process({pid}){jvm_identity(pid)} under user({user})"
+                      f"{format_sched_stats(sched_stats, pid, thread_id)}")
+    return {(pid, thread_id): NO_THREAD_STACK._replace(thread_name=thread_name)
+            for (pid, thread_id, _, _), thread_name in zip(threads, thread_names)}
+
+def print_stack_groups_of_threads(threads, round_num, sched_stats=None):
+    """
+    Print the busy threads grouped by identical stack (e.g. threads of a pool doing the same thing),
+    each group once with its threads, ranked by the total CPU of the group.
+    Return dict of (pid, thread id) -> ThreadStack of the busy threads found in jstack output.
+    """
+    dumps = collect_jstack_dumps(threads, round_num, round_deadline_time())
+    jstack_indexes = {}
+    thread_stacks = {}
+    # stack hash -> [total %CPU, thread block of the busiest thread, [(pid, thread_id, pcpu, user, thread name)]]
+    groups = {}
+    idx = 0
+    for pid, thread_id, pcpu, user in threads:
+        idx += 1
+        jstack_file, failure = dumps[pid]
+        if failure:
+            print_jstack_failure(idx, pid, thread_id, pcpu, user, failure, sched_stats)
+            continue
+
+        if pid not in jstack_indexes:
+            jstack_indexes[pid] = index_jstack_dump(jstack_file, round_num, parse_locks=lock_info is not None)
+        thread_block = jstack_indexes[pid].thread_block(read_thread_nstid(pid, thread_id))
+        if thread_block is None:
+            thread_id_hex = format(int(thread_id), 'x')
+            normal_output(f"[{idx}] Busy({pcpu}%) thread({thread_id}/{thread_id_hex}) stack of java process({pid}){jvm_identity(pid)} under user({user})"
+                          f"{format_sched_stats(sched_stats, pid, thread_id)}:")
+            normal_output(f"thread({thread_id}/{thread_id_hex}) is NOT found in jstack output, may have exited.")
+            normal_output("")
+            continue
+        with self_profile.phase(round_num, 'parsing'):
+            frames = parse_thread_frames(thread_block)
+            thread_stack = thread_stacks[(pid, thread_id)] = parse_thread_stack(thread_block, frames)
+            group_key = thread_stack.stack_hash
+        if folded_writer:
+            folded_writer.add(frames, float(pcpu))
+
+        group = groups.get(group_key)
+        if group is None:
+            group = groups[group_key] = [0.0, thread_block, []]
+        group[0] += float(pcpu)
+        group[2].append((pid, thread_id, pcpu, user, thread_stack.thread_name))
+    for jstack_index in jstack_indexes.values():
+        jstack_index.close()
+
+    for group_idx, (total_pcpu, thread_block, group_threads) in enumerate(
+            sorted(groups.values(), key=lambda group: group[0], reverse=True), 1):
+        normal_output(f"[{group_idx}] Busy({total_pcpu:.1f}%) {len(group_threads)} thread(s) with the same stack:")
+        for pid, thread_id, pcpu, user, thread_name in group_threads:
+            normal_output(f"    {pcpu}% thread({thread_id}/{int(thread_id):x}) \"{thread_name}\" of java process({pid}){jvm_identity(pid)} under user({user})"
+                          f"{format_sched_stats(sched_stats, pid, thread_id)}")
+        normal_output(thread_block)
+        normal_output("")
+    if lock_info:
+        print_lock_contention(jstack_indexes, threads, round_num)
+    return thread_stacks
+
+# max lines of the hot frames/methods of a busy thread in poor-man's profiler output
+HOT_SPOT_LINES_MAX = 20
+
+class ThreadHotSpots:
+    """
+    Hot spot statistics of a busy thread over repeated jstack samples.
+
+    Only counters of interned frame/method strings are kept, not the samples,
+    so the memory is bounded by the distinct frames of the thread.
+    """
+    __slots__ = ('thread_name', 'sample_count', 'top_frame_counts', 'method_counts', 'stack_hash_counts', 'stack_top_frames')
+
+    def __init__(self):
+        self.thread_name = None
+        self.sample_count = 0
+        self.top_frame_counts = collections.Counter()
+        self.method_counts = collections.Counter()
+        self.stack_hash_counts = collections.Counter()
+        # stack hash -> top frames of the stack
+        self.stack_top_frames = {}
+
+    def add_sample(self, thread_name, state, frames):
+        """Count the frames of the thread of a jstack sample."""
+        self.thread_name = thread_name
+        self.sample_count += 1
+        sample_stack_hash = stack_hash(state, frames)
+        self.stack_hash_counts[sample_stack_hash] += 1
+        if sample_stack_hash not in self.stack_top_frames:
+            self.stack_top_frames[sample_stack_hash] = tuple(frames[:DIFF_TOP_FRAMES])
+        if frames:
+            self.top_frame_counts[frames[0]] += 1
+        # count a method once per sample even if it appears in several frames (recursion)
+        for method in dict.fromkeys(frame_method(frame) for frame in frames):
+            self.method_counts[method] += 1
+
+def print_hot_spot_counts(title, counts, sample_count):
+    """Print the counts ranked, with the fraction of samples."""
+    normal_output(f"  {title}:")
+    for name, num in counts.most_common(HOT_SPOT_LINES_MAX):
+        normal_output(f"    {num * 100 / sample_count:5.1f}% {num:>{len(str(sample_count))}}/{sample_count}  {name}")
+    if len(counts) > HOT_SPOT_LINES_MAX:
+        normal_output(f"    ... {len(counts) - HOT_SPOT_LINES_MAX} more")
+
+def print_hot_spots_of_threads(threads, round_num, sched_stats=None):
+    """
+    Poor-man's profiler: take repeated jstack samples of the java processes of busy threads,
+    and print the frames/methods of each busy thread ranked by the fraction of samples they appear in.
+    Return dict of (pid, thread id) -> ThreadStack of the most sampled stack of the busy threads found in jstack output.
+    """
+    deadline = round_deadline_time()
+    hot_spots = {(pid, thread_id): ThreadHotSpots() for pid, thread_id, _, _ in threads}
+    failures = {}
+    for sample_num in range(profile_samples):
+        if sample_num > 0:
+            time.sleep(profile_sample_gap)
+        dumps = collect_jstack_dumps(threads, round_num, deadline, sample_num)
+        # only the blocks of busy threads are parsed, the index of the sample is dropped after use
+        jstack_indexes = {}
+        for pid, thread_id, pcpu, _ in threads:
+            jstack_file, failure = dumps[pid]
+            if failure:
+                failures[pid] = failure
                 continue
+            if pid not in jstack_indexes:
+                jstack_indexes[pid] = index_jstack_dump(jstack_file, round_num)
+            thread_block = jstack_indexes[pid].thread_block(read_thread_nstid(pid, thread_id))
+            if thread_block is not None:
+                with self_profile.phase(round_num, 'parsing'):
+                    frames = parse_thread_frames(thread_block)
+                    hot_spots[(pid, thread_id)].add_sample(parse_thread_name(thread_block), parse_thread_state(thread_block), frames)
+                if folded_writer:
+                    folded_writer.add(frames, float(pcpu) / profile_samples)
+        for jstack_index in jstack_indexes.values():
+            jstack_index.close()
+        # the tmp store dir may be a tmpfs, do not keep up all samples of giant dumps in it
+        for jstack_file, failure in dumps.values():
+            if not failure:
+                os.remove(jstack_file)
+
+    idx = 0
+    for pid, thread_id, pcpu, user in threads:
+        idx += 1
+        thread_id_hex = format(int(thread_id), 'x')
+        thread_hot_spots = hot_spots[(pid, thread_id)]
+        if thread_hot_spots.sample_count == 0 and pid in failures:
+            print_jstack_failure(idx, pid, thread_id, pcpu, user, failures[pid], sched_stats)
+            continue
+
+        normal_output(f"[{idx}] Busy({pcpu}%) thread({thread_id}/{thread_id_hex}) hot spots of java process({pid}){jvm_identity(pid)} "
+              f"under user({user}){format_sched_stats(sched_stats, pid, thread_id)}, in {thread_hot_spots.sample_count}/{profile_samples} jstack samples:")
+        if thread_hot_spots.sample_count == 0:
+            normal_output(f"thread({thread_id}/{thread_id_hex}) is NOT found in jstack output, may have exited.")
+        else:
+            normal_output(f"\"{thread_hot_spots.thread_name}\"")
+            print_hot_spot_counts("top frames", thread_hot_spots.top_frame_counts, thread_hot_spots.sample_count)
+            print_hot_spot_counts("methods", thread_hot_spots.method_counts, thread_hot_spots.sample_count)
+        normal_output("")
+    thread_stacks = {}
+    for thread_key, thread_hot_spots in hot_spots.items():
+        if thread_hot_spots.sample_count > 0:
+            top_stack_hash = thread_hot_spots.stack_hash_counts.most_common(1)[0][0]
+            thread_stacks[thread_key] = ThreadStack(top_stack_hash, thread_hot_spots.thread_name,
+                                                    thread_hot_spots.stack_top_frames[top_stack_hash])
+    return thread_stacks
+
+def print_round_diff(title, previous_threads, previous_stacks, threads, thread_stacks):
+    """
+    Print the diff of the busy threads against a previous round: the threads which become or stop being busy,
+    and of the threads busy in both rounds, the CPU delta and whether the stack changed or stays the same.
+    Stacks are compared by stack hash, the top frames are shown for the changed stacks.
+    """
+    previous_pcpus = {(pid, thread_id): pcpu for pid, thread_id, pcpu, _ in previous_threads}
+    busy_keys = {(pid, thread_id) for pid, thread_id, _, _ in threads}
+
+    def thread_desc(pid, thread_id, thread_stack):
+        thread_name = f" \"{thread_stack.thread_name}\"" if thread_stack.thread_name else ""
+        return f"thread({thread_id}/{int(thread_id):x}){thread_name} of java process({pid}){jvm_identity(pid)}"
+
+    def frames_desc(thread_stack):
+        return " <- ".join(thread_stack.top_frames) or "(no java frame)"
+
+    # section title -> lines of each thread, in the order of output
+    sections = {"newly busy": [], "no longer busy": [], "stack changed": [], "same stack": [], "still busy": []}
+    for pid, thread_id, pcpu, _ in threads:
+        thread_stack = thread_stacks.get((pid, thread_id), NO_THREAD_STACK)
+        previous_pcpu = previous_pcpus.get((pid, thread_id))
+        if previous_pcpu is None:
+            sections["newly busy"].append([f"    {pcpu}% {thread_desc(pid, thread_id, thread_stack)}"])
+            continue
+        previous_stack = previous_stacks.get((pid, thread_id), NO_THREAD_STACK)
+        if not thread_stack.thread_name:
+            thread_stack = thread_stack._replace(thread_name=previous_stack.thread_name)
+        line = f"    {pcpu}% ({float(pcpu) - float(previous_pcpu):+.1f}%) {thread_desc(pid, thread_id, thread_stack)}"
+        # the stack is not compared when it is not known of either round, e.g. jstack failure or no-dump mode
+        if not thread_stack.stack_hash or not previous_stack.stack_hash:
+            sections["still busy"].append([line])
+        elif thread_stack.stack_hash == previous_stack.stack_hash:
+            sections["same stack"].append([f"{line}, at {frames_desc(thread_stack)}"])
+        elif thread_stack.top_frames == previous_stack.top_frames:
+            sections["stack changed"].append([line, f"        top frames unchanged, deeper frames or state changed: {frames_desc(thread_stack)}"])
+        else:
+            sections["stack changed"].append([line, f"        was: {frames_desc(previous_stack)}",
+                                              f"        now: {frames_desc(thread_stack)}"])
+    for pid, thread_id, pcpu, _ in previous_threads:
+        if (pid, thread_id) not in busy_keys:
+            previous_stack = previous_stacks.get((pid, thread_id), NO_THREAD_STACK)
+            sections["no longer busy"].append([f"    was {pcpu}% {thread_desc(pid, thread_id, previous_stack)}"])
+
+    blue_output(f"Diff with {title}: " + ", ".join(f"{len(entries)} {name}" for name, entries in sections.items()) + ".")
+    for name, entries in sections.items():
+        if entries:
+            normal_output(f"  {name}:")
+            for lines in entries:
+                for line in lines:
+                    normal_output(line)
+    normal_output("")
+
+# dump_threads: the busy threads to dump, decided by the trigger of watch mode in the sampler thread
+SampledRound = collections.namedtuple('SampledRound', 'round_num timestamp epoch sampled_time sample_lag busy_threads sched_stats '
+                                                      'dump_threads rate_limited_threads')
+
+class RoundPipeline:
+    """
+    Hand-off of sampled rounds from the sampler thread to the output (main) thread,
+    so that sampling of next round overlaps with jstack and output of current round.
 
-        print(f"[{idx}] Busy({pcpu}%) thread({thread_id}/{thread_id_hex}) stack of java process({pid}) under user({user}):")
-        with open(jstack_file, 'r') as f:
-            stack_trace = f.read()
-            print(stack_trace)
+    Only the latest sampled round is pending: when jstack/output does not keep up with the
+    update delay, the stale pending round is dropped explicitly instead of falling behind.
+    A round put with block (e.g. a round triggering jstack in watch mode) is never dropped,
+    the rounds put without block meanwhile are dropped instead.
+    """
 
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.pending_round = None
+        # the pending round is put with block, not to be dropped
+        self.pending_kept = False
+        self.dropped_round_nums = []
+        self.finished = False
+        self.error = None
+        # statistics of the whole run
+        self.sampled_count = 0
+        self.dropped_count = 0
+        self.max_sample_lag = 0.0
+        self.total_sample_lag = 0.0
+        # rounds output by the output thread
+        self.output_count = 0
+
+    def put(self, sampled_round, block):
+        """
+        Put the sampled round; when the previous one is still pending, wait for it to be taken
+        if block, otherwise drop it, or drop the sampled round if the pending one is put with block.
+        """
+        with self.condition:
+            self.sampled_count += 1
+            self.max_sample_lag = max(self.max_sample_lag, sampled_round.sample_lag)
+            self.total_sample_lag += sampled_round.sample_lag
+            if block:
+                self.condition.wait_for(lambda: self.pending_round is None)
+            elif self.pending_round is not None:
+                if self.pending_kept:
+                    self.drop([sampled_round.round_num])
+                    return
+                self.drop([self.pending_round.round_num])
+            self.pending_round = sampled_round
+            self.pending_kept = block
+            self.condition.notify_all()
+
+    def drop(self, round_nums):
+        """Record the dropped rounds, which are reported by the next take."""
+        with self.condition:
+            self.dropped_round_nums.extend(round_nums)
+            self.dropped_count += len(round_nums)
+
+    def finish(self, error=None):
+        """Mark the sampling is finished, error is re-raised by the output thread."""
+        with self.condition:
+            self.finished = True
+            self.error = error
+            self.condition.notify_all()
+
+    def take(self):
+        """
+        Wait and take the pending round, return (sampled round, dropped round numbers since last take).
+        The sampled round is None when the sampling is finished.
+        """
+        with self.condition:
+            self.condition.wait_for(lambda: self.pending_round is not None or self.finished)
+            sampled_round, self.pending_round = self.pending_round, None
+            dropped_round_nums, self.dropped_round_nums = self.dropped_round_nums, []
+            self.condition.notify_all()
+            return sampled_round, dropped_round_nums
+
+def sample_rounds(pipeline):
+    """
+    Sampler thread: find busy threads of every round on a fixed cadence of update delay.
+    The rounds whose scheduled time has passed while sampling are dropped.
+    """
+    try:
+        start_time = time.monotonic()
+        round_num = 0
+        while update_count <= 0 or round_num < update_count:
+            # without update delay, rounds run back to back and have no schedule to lag behind
+            scheduled_time = start_time + round_num * update_delay if update_delay > 0 else time.monotonic()
+            now = time.monotonic()
+            if now < scheduled_time:
+                time.sleep(scheduled_time - now)
+            sample_lag = max(time.monotonic() - scheduled_time, 0.0)
+
+            now = datetime.now()
+            timestamp = now.strftime("%Y-%m-%d %H:%M:%S.%f")
+            # Find busy threads using proc filesystem, or ps/top depending on cpu_sample_interval
+            busy_threads, sched_stats = find_busy_java_threads(round_num)
+            sampled_time = time.monotonic()
+            # the trigger of watch mode sees every sampled round, also the rounds dropped by the pipeline later,
+            # and a round triggering jstack is not dropped
+            dump_threads, rate_limited_threads = busy_threads, []
+            if dump_trigger:
+                dump_threads, rate_limited_threads = dump_trigger.update(round_num, busy_threads, sampled_time)
+            pipeline.put(SampledRound(round_num, timestamp, now.timestamp(), sampled_time, sample_lag,
+                                      busy_threads, sched_stats, dump_threads, rate_limited_threads),
+                         block=update_delay == 0 or bool(dump_trigger and dump_threads))
+
+            next_round_num = round_num + 1
+            if update_delay > 0:
+                current_round_num = int((time.monotonic() - start_time) / update_delay)
+                if update_count > 0:
+                    current_round_num = min(current_round_num, update_count)
+                if current_round_num > next_round_num:
+                    pipeline.drop(range(next_round_num, current_round_num))
+                    next_round_num = current_round_num
+            round_num = next_round_num
+    except BaseException as e:
+        pipeline.finish(e)
+        return
+    pipeline.finish()
+
+def print_sampled_only_round(timestamp, round_num, busy_threads, rate_limited_threads):
+    """Print the one-line summary of a round of watch mode which is sampled only, without jstack."""
+    if busy_threads:
+        pid, thread_id, pcpu, _ = max(busy_threads, key=lambda thread: float(thread[2]))
+        hottest = f"hottest {pcpu}% thread({thread_id}/{int(thread_id):x}) of java process({pid})"
+    else:
+        hottest = "no busy thread"
+    message = f"{timestamp} [{round_num + 1}/{update_count}]: sampled only, {hottest}"
+    if rate_limited_threads:
+        message += (f", {len(rate_limited_threads)} hot thread(s) of java process(es) dumped "
+                    f"within {dump_trigger.min_dump_interval}s not dumped")
+    normal_output(message)
+
+def print_dump_trigger(dump_threads, rate_limited_threads):
+    """Print the hot threads which trigger jstack in the round of watch mode."""
+    yellow_output(f"jstack triggered by {len(dump_threads)} thread(s) at >= {dump_trigger.trigger_cpu}% CPU "
+                  f"for {dump_trigger.trigger_samples} consecutive samples:")
+    for pid, thread_id, pcpu, user in dump_threads:
+        normal_output(f"    {pcpu}% thread({thread_id}/{int(thread_id):x}) of java process({pid}){jvm_identity(pid)} under user({user})")
+    if rate_limited_threads:
+        normal_output(f"    and {len(rate_limited_threads)} hot thread(s) not dumped, "
+                      f"java process(es) dumped within {dump_trigger.min_dump_interval}s")
+    normal_output("")
+
+def print_watch_summary():
+    """Print the rounds sampled only and dumped, and the safepoint budget used of watch mode."""
+    dump_rounds = ','.join(str(n + 1) for n in dump_trigger.dump_rounds) or "none"
+    blue_output(f"watch mode: {len(dump_trigger.sampled_only_rounds)} round(s) sampled only, "
+                f"{len(dump_trigger.dump_rounds)} round(s) dumped (round {dump_rounds}); "
+                f"safepoint budget used: {dump_trigger.safepoint_count} thread dump(s), "
+                f"{dump_trigger.safepoint_seconds * 1000:.1f}ms jstack time (upper bound of pause); "
+                f"{dump_trigger.rate_limited_count} trigger(s) rate limited.")
+
+def write_self_profile():
+    """Write the self-overhead summary as JSON, to stderr or the file specified by option --self-profile."""
+    summary = json.dumps(self_profile.summary(with_rounds=update_count != 1), indent=2)
+    if self_profile_file == '-':
+        print(summary, file=sys.stderr)
+    else:
+        with open(self_profile_file, 'w') as f:
+            f.write(summary + '\n')
 
+def finish_run(pipeline):
+    """
+    Close the output files of options, and print the summaries of the run: self profile, sample lag and watch mode.
+    Run at the end of main, also when it is interrupted/terminated by signal.
+    """
+    if folded_writer:
+        folded_writer.close()
+    if history_store:
+        history_store.close()
+    if artifact_store:
+        artifact_store.close()
+    if self_profile_file:
+        write_self_profile()
+    if pipeline.error is None:
+        if update_count != 1 and pipeline.sampled_count > 0:
+            normal_output("")
+            blue_output(f"{pipeline.sampled_count} round(s) sampled, {pipeline.output_count} output, "
+                        f"{pipeline.dropped_count} dropped; sample lag max {pipeline.max_sample_lag * 1000:.1f}ms, "
+                        f"avg {pipeline.total_sample_lag / pipeline.sampled_count * 1000:.1f}ms.")
+        if dump_trigger:
+            if update_count == 1:
+                normal_output("")
+            print_watch_summary()
+    output_sink.close()
 
 def main():
-    global update_round_num
-    update_round_num = 0
-    
-    # Infinite loop if update_count <= 0, otherwise loop update_count times
-    while update_count <= 0 or update_round_num < update_count:
-        if update_round_num > 0:
-            time.sleep(update_delay)
-            normal_output()
-
-        # Capture the current timestamp
-        timestamp = datetime.now().strftime("%Y-%m-%d %H:%M:%S.%f")
-
-        # If append_file or store_dir is specified, print header info and write to files
-        if append_file or store_dir:
-            head_info(timestamp, update_round_num)
-            if append_file:
-                with open(append_file, 'a') as f:
-                    f.write(f"{head_info(timestamp, update_round_num)}\n")
-            if store_dir:
-                with open(f"{store_file_prefix}{PROG}_log", 'a') as f:
-                    f.write(f"{head_info(timestamp, update_round_num)}\n")
-
-        # Print header info if update_count is not 1
-        if update_count != 1:
-            head_info(timestamp, update_round_num)
-
-        # Find busy threads using ps or top depending on cpu_sample_interval
-        if cpu_sample_interval == 0:
-            busy_threads = find_busy_java_threads_by_ps()
-        else:
-            busy_threads = find_busy_java_threads_by_top()
+    pipeline = RoundPipeline()
+    threading.Thread(target=sample_rounds, args=(pipeline,), name="sampler", daemon=True).start()
 
-        # Print the stack trace of the busy threads
-        print_stack_of_threads(busy_threads)
+    # round diff: (title, busy threads, thread stacks) of the previous output round
+    previous_round = None
+    try:
+        while True:
+            sampled_round, dropped_round_nums = pipeline.take()
+            if dropped_round_nums:
+                yellow_output(f"Dropped round(s) {','.join(str(n + 1) for n in dropped_round_nums)}: "
+                              f"sampling/jstack/output does not keep up with update delay {update_delay}s.")
+            if sampled_round is None:
+                break
+
+            round_num = sampled_round.round_num
+            timestamp = sampled_round.timestamp
+            output_lag = time.monotonic() - sampled_round.sampled_time
+
+            # In watch mode, only the busy threads that trigger jstack are dumped
+            dump_threads = sampled_round.busy_threads
+            if dump_tids:
+                dump_threads = [thread for thread in dump_threads if thread[1] in dump_tids]
+                found_tids = {thread_id for _, thread_id, _, _ in dump_threads}
+                missing_tids = [thread_id for thread_id in dump_tids if thread_id not in found_tids]
+                if missing_tids:
+                    yellow_output(f"thread({','.join(missing_tids)}) is NOT found in java processes, may have exited.")
+            if dump_trigger:
+                dump_threads, rate_limited_threads = sampled_round.dump_threads, sampled_round.rate_limited_threads
+                if not dump_threads:
+                    print_sampled_only_round(timestamp, round_num, sampled_round.busy_threads, rate_limited_threads)
+
+            if dump_threads or not dump_trigger:
+                if pipeline.output_count > 0:
+                    normal_output("")
+                pipeline.output_count += 1
+                # Print header info if update_count is not 1, or output is also logged to files
+                if update_count != 1 or append_file or store_dir:
+                    head_info(timestamp, round_num, sampled_round.sample_lag, output_lag)
+                if dump_trigger:
+                    print_dump_trigger(dump_threads, rate_limited_threads)
+
+            # Print the stack trace, or the hot spots of repeated jstack samples, of the busy threads
+            output_start = time.perf_counter()
+            thread_stacks = {}
+            if not dump_threads:
+                pass
+            elif no_dump:
+                thread_stacks = print_busy_threads(dump_threads, round_num, timestamp, sampled_round.sched_stats)
+            elif profile_samples > 1:
+                thread_stacks = print_hot_spots_of_threads(dump_threads, round_num, sampled_round.sched_stats)
+            elif group_stacks:
+                thread_stacks = print_stack_groups_of_threads(dump_threads, round_num, sampled_round.sched_stats)
+            else:
+                thread_stacks = print_stack_of_threads(dump_threads, round_num, timestamp, sampled_round.sched_stats)
+            if round_diff:
+                if previous_round is not None:
+                    print_round_diff(*previous_round, dump_threads, thread_stacks)
+                previous_round = (f"round {round_num + 1} ({timestamp})", dump_threads, thread_stacks)
+            if dump_trigger and dump_threads:
+                dump_trigger.add_safepoints(len({pid for pid, _, _, _ in dump_threads}) * profile_samples,
+                                            sum(self_profile.jstack_pids_seconds(round_num).values()))
+            output_sink.flush()
+            # the jstack outputs of the round are stored already, or not kept without -S option
+            for jstack_file in glob.glob(f"{glob.escape(store_file_prefix)}{round_num + 1}_jstack_*"):
+                os.remove(jstack_file)
+            if artifact_store:
+                artifact_store.flush()
+            if folded_writer:
+                folded_writer.flush_round()
+            if history_store:
+                history_store.append([(sampled_round.epoch, int(pid), int(thread_id), float(pcpu),
+                                       thread_stacks.get((pid, thread_id), NO_THREAD_STACK).stack_hash)
+                                      for pid, thread_id, pcpu, _ in sampled_round.busy_threads])
+                history_store.flush()
+            # output phase is the time of printing/writing, besides jstack and parsing
+            self_profile.add(round_num, 'output', time.perf_counter() - output_start
+                             - self_profile.phase_seconds(round_num, 'jstack') - self_profile.phase_seconds(round_num, 'parsing'))
+            self_profile.end_round(round_num)
+    finally:
+        finish_run(pipeline)
+    if pipeline.error is not None:
+        raise pipeline.error
+
+METRIC_PREFIX = 'show_busy_java_threads_'
+OPENMETRICS_CONTENT_TYPE = 'application/openmetrics-text; version=1.0.0; charset=utf-8'
+
+def escape_label_value(value):
+    """Escape the label value of OpenMetrics text format."""
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def render_metrics(busy_threads, sched_stats, sample_stats):
+    """
+    Render the sampled busy threads as OpenMetrics text: per-JVM CPU usage and thread count
+    of all threads, and CPU usage of the top threads, labelled with pid, tid and thread name.
+    """
+    lines = []
+
+    def add_metric(name, metric_type, help_text, samples, suffix=''):
+        lines.append(f"# TYPE {METRIC_PREFIX}{name} {metric_type}")
+        lines.append(f"# HELP {METRIC_PREFIX}{name} {help_text}")
+        for labels, value in samples:
+            label_text = ','.join(f'{key}="{escape_label_value(label)}"' for key, label in labels.items())
+            lines.append(f"{METRIC_PREFIX}{name}{suffix}{{{label_text}}} {value}" if labels
+                         else f"{METRIC_PREFIX}{name}{suffix} {value}")
+
+    # pid -> [labels, total %CPU, thread count]
+    jvms = {}
+    for pid, _, pcpu, user in busy_threads:
+        jvm = jvms.get(pid)
+        if jvm is None:
+            labels = {'pid': pid, 'user': user}
+            fleet_jvm = fleet_jvms.get(pid)
+            if fleet_jvm is not None:
+                labels.update(container_id=fleet_jvm.container_id, nspid=fleet_jvm.nspid)
+            jvm = jvms[pid] = [labels, 0.0, 0]
+        jvm[1] += float(pcpu)
+        jvm[2] += 1
+    add_metric('jvm_cpu_percent', 'gauge', "CPU usage percentage of the java process, sum of its threads.",
+               [(labels, round(total_pcpu, 1)) for labels, total_pcpu, _ in jvms.values()])
+    add_metric('jvm_threads', 'gauge', "Thread count of the java process.",
+               [(labels, thread_count) for labels, _, thread_count in jvms.values()])
+
+    top_threads = busy_threads[:metrics_thread_count] if metrics_thread_count > 0 else busy_threads
+    thread_labels = [({'pid': pid, 'tid': thread_id, 'nid': f"0x{int(thread_id):x}",
+                       'thread_name': read_thread_name(pid, thread_id)}, pcpu)
+                     for pid, thread_id, pcpu, _ in top_threads]
+    add_metric('thread_cpu_percent', 'gauge', "CPU usage percentage of the top busy threads.",
+               [(labels, pcpu) for labels, pcpu in thread_labels])
+    if sched_stats:
+        add_metric('thread_runq_wait_seconds', 'gauge', "Time waiting on a run queue of the top busy threads "
+                   "during the CPU sample interval.",
+                   [(labels, round(sched_stats[(labels['pid'], labels['tid'])].runq_wait_ms / 1000, 6))
+                    for labels, _ in thread_labels])
+        add_metric('thread_nonvoluntary_context_switches', 'gauge', "Nonvoluntary context switches of the top busy "
+                   "threads during the CPU sample interval.",
+                   [(labels, sched_stats[(labels['pid'], labels['tid'])].nvcsw) for labels, _ in thread_labels])
+
+    add_metric('sample_timestamp_seconds', 'gauge', "Time of the latest sample.", [({}, sample_stats['timestamp'])])
+    add_metric('sample_duration_seconds', 'gauge', "Duration of the latest sample.", [({}, sample_stats['duration'])])
+    add_metric('samples', 'counter', "Samples taken.", [({}, sample_stats['samples'])], '_total')
+    add_metric('sample_failures', 'counter', "Samples failed, e.g. no java process found.",
+               [({}, sample_stats['failures'])], '_total')
+    lines.append("# EOF\n")
+    return '\n'.join(lines).encode()
+
+def serve_main():
+    """
+    The `serve` subcommand: sample the busy threads in background on the cadence of update delay,
+    and serve the latest sample as OpenMetrics at http://<listen address>/metrics.
+    Scrapes are served from the cached rendering of the latest sample, so they fork no ps/top/jstack
+    process, however frequent they are.
+    """
+    sample_stats = {'timestamp': 0.0, 'duration': 0.0, 'samples': 0, 'failures': 0}
+    # the cached rendering, replaced as a whole by the sampler thread
+    snapshot = [render_metrics([], {}, sample_stats)]
+
+    def sample_forever():
+        start_time = time.monotonic()
+        round_num = 0
+        while True:
+            now = time.monotonic()
+            scheduled_time = start_time + round_num * update_delay
+            if now < scheduled_time:
+                time.sleep(scheduled_time - now)
+
+            sample_start = time.monotonic()
+            try:
+                busy_threads, sched_stats = find_busy_java_threads(round_num)
+            except SystemExit:
+                # no java process found, it is reported by die, and keep serving
+                busy_threads, sched_stats = [], {}
+                sample_stats['failures'] += 1
+            except Exception as e:
+                # e.g. a proc file of an exiting thread in unexpected format, the sampler thread must not die
+                print(f"Error: sampling round {round_num + 1} fails: {e!r}", file=sys.stderr)
+                busy_threads, sched_stats = [], {}
+                sample_stats['failures'] += 1
+            self_profile.forget_round(round_num)
+            sample_stats['timestamp'] = round(time.time(), 3)
+            sample_stats['duration'] = round(time.monotonic() - sample_start, 6)
+            sample_stats['samples'] += 1
+            snapshot[0] = render_metrics(busy_threads, sched_stats, sample_stats)
+            if artifact_store:
+                artifact_store.flush()
+            # skip the rounds whose scheduled time has passed while sampling
+            round_num = max(round_num + 1, int((time.monotonic() - start_time) / update_delay))
+
+    class MetricsHandler(http.server.BaseHTTPRequestHandler):
+        def do_GET(self):
+            if self.path.split('?', 1)[0] != '/metrics':
+                self.send_error(404, "Only /metrics is served")
+                return
+            body = snapshot[0]
+            self.send_response(200)
+            self.send_header('Content-Type', OPENMETRICS_CONTENT_TYPE)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    try:
+        server = http.server.ThreadingHTTPServer((listen_host, int(listen_port)), MetricsHandler)
+    except OSError as e:
+        die(f"Fail to listen at {args.listen}: {e.strerror}")
+    server.daemon_threads = True
+    threading.Thread(target=sample_forever, name="sampler", daemon=True).start()
+    blue_output(f"Serving metrics at http://{args.listen}/metrics, sampling every {update_delay}s.")
+    output_sink.flush()
+    try:
+        server.serve_forever()
+    finally:
+        server.server_close()
 
-        # Increment the update round number
-        update_round_num += 1
+def load_stored_round(store_dir, run, round_num):
+    """
+    Load the artifacts of a round stored by option -S, the latest round of the (latest) run if round_num is None.
+    Return (run, round number, dict of artifact name -> bytes), None if not found.
+    """
+    manifests = [(pack_path, manifest) for pack_path, manifest in iter_store_manifests(store_dir)
+                 if (run is None or manifest['run'].startswith(run))
+                 and (round_num is None or manifest['round'] == round_num)]
+    if not manifests:
+        return None
+    run, round_num = max((manifest['run'], manifest['round']) for _, manifest in manifests)
+    pack_manifests = {}
+    for pack_path, manifest in manifests:
+        if manifest['run'] == run and manifest['round'] == round_num:
+            pack_manifests.setdefault(pack_path, []).append(manifest)
+    artifacts = {}
+    for pack_path, pack_round_manifests in pack_manifests.items():
+        for manifest, artifact in zip(pack_round_manifests, restore_artifacts(pack_path, pack_round_manifests)):
+            artifacts[manifest['name']] = artifact
+    return run, round_num, artifacts
+
+def parse_stored_busy_threads(artifacts):
+    """Parse the busy threads, ranked, from the proc, top and ps outputs of a stored round."""
+    def output_of(name):
+        # the first line of the stored output is the command line
+        return artifacts[name].decode(errors='replace').split('\n', 1)[-1]
+
+    if 'proc' in artifacts:
+        return [tuple(line.split()[:4]) for line in output_of('proc').splitlines() if line.strip()]
+    if 'top' in artifacts and 'ps' in artifacts:
+        return complete_pid_user(parse_top_output(output_of('top')), output_of('ps'))
+    if 'ps' in artifacts:
+        return [tuple(line.split()[:4]) for line in output_of('ps').splitlines() if line.strip()]
+    return []
+
+def diff_main(argv):
+    """
+    The `diff` subcommand: diff the busy threads and their stacks of two rounds stored by option -S,
+    e.g. before and after a deploy, the same way as option --diff between rounds.
+    """
+    diff_parser = argparse.ArgumentParser(prog=f"{PROG} diff", description="Diff the busy threads of two rounds stored by option -S.")
+    diff_parser.add_argument("old_store_dir", help="store directory of option -S of the old round")
+    diff_parser.add_argument("new_store_dir", help="store directory of option -S of the new round, may be the same one")
+    diff_parser.add_argument("--old-run", help="run of the old round, by its timestamp (prefix), default the latest run")
+    diff_parser.add_argument("--old-round", type=int, help="the old round, default the latest round of the run")
+    diff_parser.add_argument("--new-run", help="run of the new round, by its timestamp (prefix), default the latest run")
+    diff_parser.add_argument("--new-round", type=int, help="the new round, default the latest round of the run")
+    diff_parser.add_argument("-c", "--count", type=int, default=5, help="top threads count of each round to diff (default: 5)")
+    diff_args = diff_parser.parse_args(argv)
+
+    rounds = []
+    for store, run, round_num in ((diff_args.old_store_dir, diff_args.old_run, diff_args.old_round),
+                                  (diff_args.new_store_dir, diff_args.new_run, diff_args.new_round)):
+        if not os.path.isdir(store):
+            diff_parser.error(f"store directory {store} is not found!")
+        stored_round = load_stored_round(store, run, round_num)
+        if stored_round is None:
+            diff_parser.error(f"no stored round is found in {store}!")
+        run, round_num, artifacts = stored_round
+        threads = parse_stored_busy_threads(artifacts)
+        if diff_args.count > 0:
+            threads = threads[:diff_args.count]
+
+        # the stored jstack output of each java process is indexed from a scratch file, as the jstack output of a round;
+        # the thread id is taken as nid, the pid namespace of the java process is not known offline
+        thread_stacks = {}
+        for pid in dict.fromkeys(pid for pid, _, _, _ in threads):
+            jstack_output = artifacts.get(f"jstack_{pid}", artifacts.get(f"jstack_{pid}_1"))
+            if jstack_output is None:
+                continue
+            jstack_file = f"{store_file_prefix}diff_{len(rounds)}_jstack_{pid}"
+            with open(jstack_file, 'wb') as f:
+                f.write(jstack_output)
+            jstack_index = JstackDumpIndex(jstack_file)
+            for thread_pid, thread_id, _, _ in threads:
+                thread_block = jstack_index.thread_block(thread_id) if thread_pid == pid else None
+                if thread_block is not None:
+                    thread_stacks[(pid, thread_id)] = parse_thread_stack(thread_block, parse_thread_frames(thread_block))
+            jstack_index.close()
+            os.remove(jstack_file)
+        rounds.append((f"run {run} round {round_num}", threads, thread_stacks))
+
+    (old_title, old_threads, old_stacks), (new_title, new_threads, new_stacks) = rounds
+    if old_title == new_title and os.path.samefile(diff_args.old_store_dir, diff_args.new_store_dir):
+        diff_parser.error(f"the old and new rounds are the same one ({old_title}), select them by --old-round/--new-round!")
+    normal_output(f"{new_title} of {diff_args.new_store_dir}:")
+    print_round_diff(f"{old_title} of {diff_args.old_store_dir}", old_threads, old_stacks, new_threads, new_stacks)
+    output_sink.close()
+    return 0
 
 if __name__ == "__main__":
-    main()
+    if args.attach_helper:
+        sys.exit(attach_helper_main())
+    elif serve_mode:
+        serve_main()
+    elif diff_mode:
+        sys.exit(diff_main(sys.argv[2:]))
+    else:
+        main()
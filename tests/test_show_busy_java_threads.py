@@ -0,0 +1,286 @@
+#!/usr/bin/env python3
+# Tests of show-busy-java-threads with fixture inputs.
+#
+# Usage:
+#   $ python -m pytest -q tests
+#
+import os
+import sys
+import socket
+import threading
+import types
+import importlib.util
+
+import pytest
+
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+TOOL_PATH = os.path.join(TESTS_DIR, '..', 'bin', 'show-busy-java-threads.py')
+
+
+@pytest.fixture(scope='module')
+def tool(tmp_path_factory):
+    """
+    Load show-busy-java-threads as module. The tool parses its command line when loaded,
+    so load it in socket attach mode (no jstack lookup) with the proc sampler on an empty proc tree.
+    """
+    argv = sys.argv
+    sys.argv = [TOOL_PATH, '--attach-mode', 'socket', '--sampler', 'proc',
+                '--proc-root', str(tmp_path_factory.mktemp('proc')), '-c', '0']
+    try:
+        spec = importlib.util.spec_from_file_location('show_busy_java_threads', TOOL_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.argv = argv
+    return module
+
+
+# the holder locks X; the re-locker is notified in X.wait() and waits to re-lock X,
+# jstack still lists X as locked in its caller frame; the blocked thread waits to lock X
+RELOCK_DUMP = b'''\
+Full thread dump OpenJDK 64-Bit Server VM (17.0.1+12 mixed mode, sharing):
+
+"holder" #10 prio=5 os_prio=0 cpu=1.00ms elapsed=2.00s tid=0x00007f0000000064 nid=0x64 runnable  [0x00007f]
+   java.lang.Thread.State: RUNNABLE
+\tat com.example.Holder.run(Holder.java:10)
+\t- locked <0x000000071a2b3c40> (a java.lang.Object)
+
+"re-locker" #11 prio=5 os_prio=0 cpu=1.00ms elapsed=2.00s tid=0x00007f0000000065 nid=0x65 in Object.wait()  [0x00007f]
+   java.lang.Thread.State: BLOCKED (on object monitor)
+\tat java.lang.Object.wait(java.base@17.0.1/Native Method)
+\t- waiting to re-lock in wait() <0x000000071a2b3c40> (a java.lang.Object)
+\tat com.example.Waiter.run(Waiter.java:20)
+\t- locked <0x000000071a2b3c40> (a java.lang.Object)
+
+"blocked" #12 prio=5 os_prio=0 cpu=1.00ms elapsed=2.00s tid=0x00007f0000000066 nid=0x66 waiting for monitor entry  [0x00007f]
+   java.lang.Thread.State: BLOCKED (on object monitor)
+\tat com.example.Blocked.run(Blocked.java:30)
+\t- waiting to lock <0x000000071a2b3c40> (a java.lang.Object)
+
+JNI global refs: 15, weak refs: 0
+'''
+
+
+def test_lock_graph_of_relocking_thread(tool, tmp_path):
+    jstack_file = tmp_path / 'jstack'
+    jstack_file.write_bytes(RELOCK_DUMP)
+    jstack_index = tool.JstackDumpIndex(str(jstack_file), parse_locks=True)
+    jstack_index.close()
+
+    assert jstack_index.lock_owners == {'0x000000071a2b3c40': 0x64}
+    lock_graph = tool.LockGraph(jstack_index)
+    assert lock_graph.next_nids == {0x65: 0x64, 0x66: 0x64}
+    assert lock_graph.cycles == []
+    assert lock_graph.blocking_chains() == [(2, [0x65, 0x64])]
+
+
+def test_thread_dump_by_attach_socket(tool, tmp_path):
+    # the stand-in of the attach socket of the JVM, under the proc tree of the fixture
+    pid = '4242'
+    socket_dir = os.path.join(tool.proc_root, pid, 'root', 'tmp')
+    os.makedirs(socket_dir)
+    requests = []
+
+    def serve(server):
+        connection, _ = server.accept()
+        with connection:
+            request = b''
+            while request.count(b'\0') < 2 + tool.ATTACH_ARG_COUNT_MAX:
+                request += connection.recv(1024)
+            requests.append(request)
+            connection.sendall(b'0\n' + RELOCK_DUMP)
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+        server.bind(os.path.join(socket_dir, f'.java_pid{pid}'))
+        server.listen()
+        server_thread = threading.Thread(target=serve, args=(server,))
+        server_thread.start()
+        jstack_file = tmp_path / 'jstack'
+        failure = tool.dump_threads_by_socket(pid, tool.WHOAMI, str(jstack_file), 5, 0)
+        server_thread.join()
+
+    assert failure is None
+    assert requests == [b'1\0threaddump\0\0\0\0']
+    assert jstack_file.read_bytes() == RELOCK_DUMP
+
+
+def test_attach_listener_of_fixture_pid_is_not_signalled(tool):
+    # the pid of pytest itself: SIGQUIT would kill it, the pid under the fixture proc tree is not signalled
+    pid = str(os.getpid())
+    os.makedirs(os.path.join(tool.proc_root, pid, 'cwd'))
+    with pytest.raises(tool.AttachError, match='attach listener .* is not started'):
+        tool.attach_thread_dump(pid, 1, 0.2)
+    assert os.listdir(os.path.join(tool.proc_root, pid, 'cwd')) == []
+
+
+def write_thread_stat(proc_root, pid, tid, cpu_ticks, start_ticks=0):
+    """Write the stat file of a thread, with utime/stime (field 14/15) and starttime (field 22) of proc(5)."""
+    task_dir = proc_root / pid / 'task' / tid
+    task_dir.mkdir(parents=True, exist_ok=True)
+    fields = ['S'] + ['0'] * 10 + [str(cpu_ticks - cpu_ticks // 4), str(cpu_ticks // 4)] + ['0'] * 6 + [str(start_ticks)]
+    (task_dir / 'stat').write_text(f"{tid} (VM Thread (1)) {' '.join(fields)}\n")
+
+
+@pytest.fixture
+def java_proc(tool, tmp_path, monkeypatch):
+    """A proc tree of the java process 100 under the current user, with 100 clock ticks per second."""
+    proc_root = tmp_path / 'proc'
+    (proc_root / '100').mkdir(parents=True)
+    (proc_root / '100' / 'comm').write_text('java\n')
+    (proc_root / '100' / 'status').write_text(f'Uid:\t{os.getuid()}\t{os.getuid()}\t0\t0\n'
+                                               f'Gid:\t{os.getgid()}\t{os.getgid()}\t0\t0\n')
+    monkeypatch.setattr(tool, 'proc_root', str(proc_root))
+    monkeypatch.setattr(tool, 'CLK_TCK', 100)
+    return proc_root
+
+
+def test_proc_sampler_cpu_of_sample_interval(tool, java_proc, monkeypatch):
+    write_thread_stat(java_proc, '100', '101', 1000)
+    write_thread_stat(java_proc, '100', '102', 2000)
+
+    # the threads run during the sample interval of 0.5s (50 ticks): 101 for 40 ticks,
+    # 102 for none, 103 started during the interval for 10 ticks
+    def sleep(seconds):
+        clock.now += seconds
+        write_thread_stat(java_proc, '100', '101', 1040)
+        write_thread_stat(java_proc, '100', '103', 10)
+
+    clock = types.SimpleNamespace(now=1000.0, sleep=sleep)
+    clock.monotonic = clock.perf_counter = lambda: clock.now
+    monkeypatch.setattr(tool, 'time', clock)
+    monkeypatch.setattr(tool, 'cpu_sample_interval', 0.5)
+
+    busy_threads, sched_stats = tool.find_busy_java_threads_by_proc(0)
+    user = tool.read_process_user('100')
+    assert busy_threads == [('100', '101', '80.0', user), ('100', '103', '20.0', user), ('100', '102', '0.0', user)]
+    assert sched_stats[('100', '101')] == tool.NO_SCHED_STATS
+
+
+def test_proc_sampler_cpu_of_thread_lifetime(tool, java_proc, monkeypatch):
+    # uptime 100s (10000 ticks), the threads started at tick 5000 and 9000
+    (java_proc / 'uptime').write_text('100.00 50.00\n')
+    write_thread_stat(java_proc, '100', '101', 1250, start_ticks=5000)
+    write_thread_stat(java_proc, '100', '102', 500, start_ticks=9000)
+    monkeypatch.setattr(tool, 'cpu_sample_interval', 0)
+
+    busy_threads, _ = tool.find_busy_java_threads_by_proc(0)
+    assert [thread[1:3] for thread in busy_threads] == [('102', '50.0'), ('101', '25.0')]
+
+
+def test_jstack_dump_index_of_hex_and_decimal_nids(tool, tmp_path):
+    # nid is hex before JDK 19, decimal since JDK 19
+    decimal_dump = RELOCK_DUMP.replace(b'nid=0x64', b'nid=100').replace(b'nid=0x65', b'nid=101').replace(b'nid=0x66', b'nid=102')
+    for name, dump in (('hex', RELOCK_DUMP), ('decimal', decimal_dump)):
+        jstack_file = tmp_path / name
+        jstack_file.write_bytes(dump)
+        jstack_index = tool.JstackDumpIndex(str(jstack_file))
+        try:
+            assert sorted(jstack_index.nid_offsets) == [100, 101, 102]
+            assert jstack_index.thread_block('101').startswith('"re-locker" #11')
+            assert jstack_index.thread_block('102').endswith('- waiting to lock <0x000000071a2b3c40> (a java.lang.Object)')
+            assert jstack_index.thread_block('103') is None
+        finally:
+            jstack_index.close()
+
+
+def test_history_store_rotation_and_query(tool, tmp_path, capsys):
+    history_file = str(tmp_path / 'history')
+    # 2 records fit in a file
+    history_store = tool.HistoryStore(history_file, tool.HistoryStore.HEADER.size + 2 * tool.HistoryStore.RECORD.size)
+    batches = [[(1000.0 + n, 1, 10, 50.0 + n, 0xabc), (1000.0 + n, 1, 11, 25.0, 0xdef)] for n in range(6)]
+    for batch in batches:
+        history_store.append(batch)
+    history_store.close()
+
+    # the current file and 4 rotated files are kept, the oldest batch is removed
+    assert tool.history_files(history_file) == [f"{history_file}.{n}" for n in range(4, 0, -1)] + [history_file]
+    assert list(tool.iter_history_records(history_file)) == [record for batch in batches[1:] for record in batch]
+
+    assert tool.query_main([history_file, '--from', '1002', '-c', '1']) == 0
+    lines = capsys.readouterr().out.splitlines()
+    assert len(lines) == 2
+    # pid tid nid samples avg%CPU max%CPU stack hash of max
+    assert lines[1].split() == ['1', '10', '0xa', '4', '53.5', '55.0', '0000000000000abc']
+
+
+def test_history_records_of_truncated_file(tool, tmp_path):
+    history_file = str(tmp_path / 'history')
+    history_store = tool.HistoryStore(history_file, 1024 * 1024)
+    records = [(1000.0 + n, 1, 10, 50.0, 0xabc) for n in range(5)]
+    history_store.append(records)
+    history_store.close()
+    # the header counts 5 records, the file has 3 and a partial one
+    os.truncate(history_file, tool.HistoryStore.HEADER.size + 3 * tool.HistoryStore.RECORD.size + 5)
+    assert list(tool.iter_history_records(history_file)) == records[:3]
+
+
+def test_artifact_store_round_trip(tool, tmp_path):
+    store_dir = tmp_path / 'store'
+    store_dir.mkdir()
+    jstack_file = tmp_path / 'jstack'
+    jstack_file.write_bytes(RELOCK_DUMP)
+    artifact_store = tool.ArtifactStore(str(store_dir), '2024-01-02_03:04:05.000000', 0)
+    artifact_store.add_text(0, 'proc', '100 101 80.0 root\n')
+    artifact_store.add_dump(0, 'jstack_100', str(jstack_file))
+    artifact_store.flush()
+    # the unchanged thread blocks of the next round are stored once
+    jstack_file.write_bytes(RELOCK_DUMP.replace(b'cpu=1.00ms elapsed=2.00s', b'cpu=2.00ms elapsed=3.00s'))
+    artifact_store.add_dump(1, 'jstack_100', str(jstack_file))
+    artifact_store.close()
+
+    [pack_path] = tool.store_packs(str(store_dir))
+    kinds = [kind for kind, _ in tool.iter_pack_records(pack_path)]
+    assert kinds.count(tool.ArtifactStore.BLOCK_RECORD) == 3
+    manifests = [manifest for _, manifest in tool.iter_store_manifests(str(store_dir))]
+    assert [(manifest['round'], manifest['name']) for manifest in manifests] == [(1, 'proc'), (1, 'jstack_100'), (2, 'jstack_100')]
+    assert tool.restore_artifacts(pack_path, manifests) == [b'100 101 80.0 root\n', RELOCK_DUMP, jstack_file.read_bytes()]
+
+    output_dir = tmp_path / 'restored'
+    assert tool.restore_main([str(store_dir), '-r', '2', '-o', str(output_dir)]) == 0
+    assert (output_dir / '2024-01-02_03:04:05.000000_2_jstack_100').read_bytes() == jstack_file.read_bytes()
+
+
+def test_artifact_store_rotation_keeps_active_packs(tool, tmp_path):
+    store_dir = str(tmp_path / 'store')
+    os.mkdir(store_dir)
+    finished_store = tool.ArtifactStore(store_dir, '2024-01-01_00:00:00.000000', 0)
+    finished_store.add_text(0, 'proc', 'finished run\n')
+    finished_store.close()
+    concurrent_store = tool.ArtifactStore(store_dir, '2024-01-02_00:00:00.000000', 0)
+    concurrent_store.add_text(0, 'proc', 'concurrent run\n')
+    concurrent_store.flush()
+
+    # roll over at every flush, and rotate to keep the store dir at 1 byte
+    artifact_store = tool.ArtifactStore(store_dir, '2024-01-03_00:00:00.000000', 1)
+    artifact_store.segment_bytes = 1
+    artifact_store.add_text(0, 'proc', 'this run\n')
+    artifact_store.flush()
+    try:
+        assert tool.store_packs(store_dir) == [concurrent_store.pack_path, artifact_store.pack_path]
+    finally:
+        artifact_store.close()
+        concurrent_store.close()
+
+
+def test_dump_trigger_hysteresis(tool):
+    # trigger at 80%, released below 50%, after 2 hot samples; a java process is dumped once every 60s
+    dump_trigger = tool.DumpTrigger(80, 50, 2, 60)
+
+    def update(round_num, pcpu, now):
+        return dump_trigger.update(round_num, [('1', '10', pcpu, 'user')], now)
+
+    hot_thread = [('1', '10', '60.0', 'user')]
+    # 60% does not start a streak, but continues the streak started at 90%
+    assert update(0, '60.0', 0) == ([], [])
+    assert update(1, '90.0', 1) == ([], [])
+    assert update(2, '60.0', 2) == (hot_thread, [])
+    # no dump again until the streak is broken
+    assert update(3, '90.0', 3) == ([], [])
+    assert update(4, '40.0', 4) == ([], [])
+    assert update(5, '90.0', 5) == ([], [])
+    # rate limited by min dump interval, then triggers when the interval has passed
+    assert update(6, '60.0', 6) == ([], hot_thread)
+    assert update(7, '60.0', 70) == (hot_thread, [])
+    assert dump_trigger.dump_rounds == [2, 7]
+    assert dump_trigger.rate_limited_count == 1